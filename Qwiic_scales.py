@@ -1,30 +1,104 @@
-import qwiic
 from datetime import datetime, timedelta
-import PyNAU7802
-import smbus2
 import argparse
 import json
 import os
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import pandas as pd
+from contextlib import contextmanager
+import gdrive_client
+from weight_store import WeightStore, Uploader, SheetsSink, CsvSink
+from filters import make_filter
+from timeseries import TimeSeriesStore
+from readings import ReadingBuffer
+from temperature import TemperatureLog, TemperatureMonitor
+import hardware
+from metrics import metrics
 
 
 
+import signal
+import statistics
+import threading
 import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Columns appended to the weight sheet, the remaining read_weights columns are kept local
+WEIGHT_COLUMNS = ["Timestamp", "Multiplexer", "Scale", "Weight", "Raw"]
+READING_COLUMNS = WEIGHT_COLUMNS + ["Std", "Samples"]
+
+# NAU7802 CTRL2 CRS and CTRL1 GAINS register values (PyNAU7802.NAU7802_SPS_* and NAU7802_GAIN_*)
+# for the supported sample rates (conversions per second) and gains
+SAMPLE_RATES = {10: 0b000, 20: 0b001, 40: 0b010, 80: 0b011, 320: 0b111}
+GAINS = {1: 0b000, 2: 0b001, 4: 0b010, 8: 0b011, 16: 0b100, 32: 0b101, 64: 0b110, 128: 0b111}
+# Settings applied by PyNAU7802's begin()
+DEFAULT_SAMPLE_RATE = 80
+DEFAULT_GAIN = 128
+
+# Result of one sampling pass of a scale. raw is the mean conversion, std its standard deviation
+Reading = namedtuple("Reading", ["weight", "raw", "std", "samples"])
 
 
 class MuxBoard:
+    """
+    A TCA9548A multiplexer, either directly on an I2C bus or cascaded behind a port of a parent
+    multiplexer on the same bus. A cascaded board selects its parent port before every write, so
+    the same address can be reused behind each parent port.
+    """
 
-    def __init__(self, i2c):
+    def __init__(self, i2c, bus_number=1, parent=None, parent_port=None):
+        """
+        :param i2c: multiplexer address as a hex string eg. 0x70
+        :param bus_number: I2C bus number eg. 1 for /dev/i2c-1
+        :param parent: MuxBoard this multiplexer is wired behind, None if it is directly on the bus
+        :param parent_port: port of the parent multiplexer
+        """
         self.i2c = int(i2c, 16)
-        self.mux = qwiic.QwiicTCA9548A(address=self.i2c)
+        self.bus_number = bus_number
+        self.parent = parent
+        self.parent_port = None if parent is None else int(parent_port)
+        self.id = self.get_id()
+        self.mux = hardware.get_backend().make_mux(self.i2c, bus_number, None if parent is None else parent.mux,
+                                                   self.parent_port)
         self.ports = [0, 1, 2, 3, 4, 5, 6, 7]
-        self.disable_port(self.ports)
+        self.active_port = None
+        self.writes = 0
+        self.writes_saved = 0
+        self.write_channels(0)
         if self.mux.is_connected():
-            print("Successfully connected to QwiicTCA9548A at {0}".format(hex(self.i2c)))
+            print("Successfully connected to QwiicTCA9548A at {0}".format(self.id))
         else:
-            print("Connection Failed for QwiicTCA9548A at {0}!".format(hex(self.i2c)))
+            print("Connection Failed for QwiicTCA9548A at {0}!".format(self.id))
+
+    def get_id(self):
+        """
+        Multiplexer name used for calibrations and logs: the address for a multiplexer directly on
+        bus 1, otherwise prefixed with the bus and the parent multiplexer and port eg. i2c-3/0x70/7/0x71
+        :return: string
+        """
+        if self.parent is not None:
+            return "{0}/{1}/{2}".format(self.parent.id, self.parent_port, hex(self.i2c))
+        if self.bus_number != 1:
+            return "i2c-{0}/{1}".format(self.bus_number, hex(self.i2c))
+        return hex(self.i2c)
+
+    def route(self):
+        """
+        Selects the parent port leading to a cascaded multiplexer.
+        :return: None
+        """
+        if self.parent is not None:
+            self.parent.select(self.parent_port)
+
+    def write_channels(self, mask):
+        """
+        Sets which ports are enabled with a single write of the control register.
+        :param mask: bit mask of the ports to enable
+        :return: None
+        """
+        self.route()
+        hardware.get_backend().set_mux_channels(self.mux, mask)
+        self.writes += 1
+        metrics.count("mux_writes_total", mux=self.id)
 
     def enable_port(self, ports):
         """
@@ -32,7 +106,10 @@ class MuxBoard:
             :param ports: Multiplexer port(s) to enable.
             :return: None
             """
+        self.route()
         self.mux.enable_channels(ports)
+        self.writes += 1
+        metrics.count("mux_writes_total", mux=self.id)
 
     def disable_port(self, ports):
         """
@@ -40,7 +117,52 @@ class MuxBoard:
                 :param ports: Multiplexer port(s) to disable.
                 :return: None
         """
+        self.route()
         self.mux.disable_channels(ports)
+        self.writes += 1
+        metrics.count("mux_writes_total", mux=self.id)
+        if self.active_port is not None and self.active_port in (ports if isinstance(ports, list) else [ports]):
+            self.active_port = None
+
+    def select(self, port):
+        """
+        Makes port the only enabled port, skipping the I2C write if it is already selected.
+        :param port: Multiplexer port to select
+        :return: None
+        """
+        if self.active_port == port:
+            self.writes_saved += 1
+            metrics.count("mux_writes_saved_total", mux=self.id)
+            return
+        self.write_channels(1 << port)
+        self.active_port = port
+
+    def release(self):
+        """
+        Disables the selected port.
+        :return: None
+        """
+        if self.active_port is not None:
+            self.write_channels(0)
+            self.active_port = None
+
+    @contextmanager
+    def channel(self, port):
+        """
+        Context manager that enables port for the duration of a single operation.
+        :param port: Multiplexer port to enable
+        """
+        self.select(port)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def get_write_stats(self):
+        """
+        :return: tuple of (I2C writes made, I2C writes skipped) to the multiplexer
+        """
+        return self.writes, self.writes_saved
 
 
 class Scale:
@@ -48,34 +170,63 @@ class Scale:
     def __init__(self, mux, port):
         self.mux_board = mux
         self.port = int(port)
-        self.scale = PyNAU7802.NAU7802()
+        self.scale = hardware.get_backend().make_adc(mux.mux, self.port)
+        # multiplexer-port label used in log messages and metrics eg. 0x70-0
+        self.name = "{0}-{1}".format(mux.id, self.port)
         self.zero_offset = float()
         self.cal_factor = float()
+        self.ready = False
+        self.configured = False
+        self.filter = None
+        self.sample_rate = DEFAULT_SAMPLE_RATE
+        self.gain = DEFAULT_GAIN
+        self.samples = None
+        self.achieved_rate = None
 
     def tare_scale(self):
-        self.mux_board.mux.enable_channels(self.port)
-        self.scale.calculateZeroOffset()
-        self.zero_offset = self.scale.getZeroOffset()
-        cal = float(input("Enter Mass in kg"))
-        self.scale.calculateCalibrationFactor(cal)
-        self.cal_factor = self.scale.getCalibrationFactor()
-        self.mux_board.mux.disable_channels(self.port)
-
-    def is_connected(self):
-        bus = smbus2.SMBus(1)
-        self.mux_board.mux.enable_channels(self.port)
-        try:
-            if self.scale.begin(bus):
-                return True
-            else:
-                return False
-        finally:
-            self.mux_board.mux.disable_channels(self.port)
+        with self.mux_board.channel(self.port):
+            self.scale.calculateZeroOffset()
+            self.zero_offset = self.scale.getZeroOffset()
+            cal = float(input("Enter Mass in kg"))
+            self.scale.calculateCalibrationFactor(cal)
+            self.cal_factor = self.scale.getCalibrationFactor()
+
+    def is_connected(self, bus=None):
+        """
+        Initialises the NAU7802 the first time it is called and after a failed read.
+        :param bus: open SMBus handle, a new handle to the multiplexer's bus is opened if None
+        :return: True if the scale is initialised and responding
+        """
+        if self.ready:
+            return True
+        if bus is None:
+            bus = hardware.get_backend().open_bus(self.mux_board.bus_number)
+        metrics.count("nau7802_begins_total", scale=self.name)
+        with self.mux_board.channel(self.port), metrics.timer("stage_seconds", stage="begin", scale=self.name):
+            try:
+                self.ready = bool(self.scale.begin(bus))
+                # begin() sets 80 SPS and x128 gain, only reprogram and recalibrate the front end if different
+                if self.ready and (self.sample_rate != DEFAULT_SAMPLE_RATE or self.gain != DEFAULT_GAIN):
+                    self.ready = (self.scale.setSampleRate(SAMPLE_RATES[self.sample_rate]) and
+                                  self.scale.setGain(GAINS[self.gain]) and
+                                  self.scale.calibrateAFE())
+            except IOError:
+                self.ready = False
+        return self.ready
+
+    def mark_failed(self):
+        """
+        Flags the scale for re-initialisation on the next is_connected() call.
+        :return: None
+        """
+        self.ready = False
 
     def set_zero_offset(self, zero_offset):
+        self.zero_offset = zero_offset
         self.scale.setZeroOffset(zero_offset)
 
     def set_cal_factor(self, cal_factor):
+        self.cal_factor = cal_factor
         self.scale.setCalibrationFactor(cal_factor)
 
     def get_zero_offset(self):
@@ -87,48 +238,550 @@ class Scale:
     def get_port(self):
         return self.port
 
+    def read_average(self, average_amount=8):
+        """
+        Averages conversions from the NAU7802, the multiplexer port must already be enabled.
+        :param average_amount: number of conversions to average
+        :return: average raw reading
+        """
+        raw_value = self.scale.getAverage(average_amount=average_amount)
+        # PyNAU7802 swallows I2C errors and returns 0 when no conversion arrives in time
+        if raw_value == 0:
+            raise IOError("no conversion received from NAU7802")
+        return raw_value
+
     def get_weight(self):
-        self.mux_board.mux.enable_channels(self.port)
-        five_weights = [self.scale.getWeight() for i in range(5)]
+        with self.mux_board.channel(self.port):
+            five_weights = [(self.read_average() - self.scale.getZeroOffset()) / self.scale.getCalibrationFactor()
+                            for i in range(5)]
         average_weight = round((sum(five_weights) / len(five_weights)), 3)
-        self.mux_board.mux.disable_channels(self.port)
         return average_weight
 
     def get_average(self):
-        self.mux_board.mux.enable_channels(self.port)
-        raw_value = self.scale.getAverage(average_amount=8)
-        self.mux_board.mux.disable_channels(self.port)
+        with self.mux_board.channel(self.port):
+            raw_value = self.read_average(average_amount=8)
         return raw_value
 
-    def write_calibration(self, file):
-        scale_cal = {str(self.port): (self.get_zero_offset(), self.get_cal_factor())}
-        mux_id = hex(self.mux_board.i2c)
-        try:
-            with open(file, "r+") as cal_file:
+    def read_conversion(self):
+        """
+        Reads the latest ADC conversion if a new one is ready, the multiplexer port must already be enabled.
+        :return: raw reading or None if no new conversion is available
+        """
+        metrics.count("nau7802_reads_total", op="data_ready")
+        if not self.scale.available():
+            return None
+        metrics.count("nau7802_reads_total", op="conversion")
+        value = self.scale.getReading()
+        # PyNAU7802 returns False instead of raising when the NAU7802 does not ACK
+        if value is False:
+            raise IOError("NAU7802 did not acknowledge reading")
+        return value
+
+    def get_poll_interval(self):
+        """
+        :return: seconds to wait between data-ready checks, a quarter of the conversion period
+        """
+        return 0.25 / self.sample_rate
+
+    def record_rate(self, samples, seconds):
+        """
+        Records the scale's conversion rate during the last reading.
+        :param samples: number of conversion periods
+        :param seconds: time they took
+        :return: None
+        """
+        if seconds > 0:
+            self.achieved_rate = samples / seconds
+
+    def make_reading(self, raw_samples):
+        """
+        Computes the raw mean and calibrated weight from the same set of conversions.
+        :param raw_samples: list of raw readings
+        :return: Reading
+        """
+        std = statistics.stdev(raw_samples) if len(raw_samples) > 1 else 0.0
+        # raw stays the unfiltered mean of the ADC counts so weights can be re-derived from the log
+        raw = sum(raw_samples) / len(raw_samples)
+        if self.filter is None:
+            weight = (raw - self.zero_offset) / self.cal_factor
+        else:
+            # the filter runs on per-sample weights so its thresholds are in kg, its state carries over between calls
+            for value in raw_samples:
+                weight = self.filter.update((value - self.zero_offset) / self.cal_factor)
+        return Reading(weight=round(weight, 3), raw=raw, std=std, samples=len(raw_samples))
+
+    def configure(self, config):
+        """
+        Applies the scale's treatment file settings. The sample rate and gain are programmed at the
+        next begin(), so configure the scale before is_connected().
+        :param config: dictionary of scale settings:
+            "sample_rate": conversions per second, one of 10, 20, 40, 80, 320
+            "gain": programmable gain, one of 1, 2, 4, 8, 16, 32, 64, 128
+            "samples": conversions per reading
+            "filter": streaming filter eg. {"type": "median", "window": 5}
+        :return: None
+        """
+        sample_rate = int(config.get("sample_rate", DEFAULT_SAMPLE_RATE))
+        gain = int(config.get("gain", DEFAULT_GAIN))
+        if sample_rate not in SAMPLE_RATES:
+            raise ValueError("unsupported sample rate {0}, expected one of {1}".format(sample_rate, sorted(SAMPLE_RATES)))
+        if gain not in GAINS:
+            raise ValueError("unsupported gain {0}, expected one of {1}".format(gain, sorted(GAINS)))
+        if (sample_rate, gain) != (self.sample_rate, self.gain):
+            self.ready = False
+        self.sample_rate = sample_rate
+        self.gain = gain
+        self.samples = int(config["samples"]) if "samples" in config else None
+        self.filter = make_filter(config.get("filter"))
+        self.configured = True
+
+
+class CalibrationStore:
+    """
+    Calibrations of every scale loaded once into an index keyed by (multiplexer id, port),
+    each holding one (zero offset, calibration factor) per calibration temperature. Lookups
+    interpolate linearly between the calibration temperatures either side of the current one.
+
+    File format: {"0x70": {"0": {"21.5": [zero offset, calibration factor], ...}}}, multiplexers on
+    other buses or behind a parent multiplexer are keyed by their MuxBoard id eg. "i2c-3/0x70". Files from
+    earlier versions ({"0x70": {"0": [zero offset, calibration factor]}}) load as a calibration
+    without a temperature. A scale's calibration without a temperature is only used until it is
+    calibrated at a known temperature.
+    """
+
+    def __init__(self, path, import_legacy=False):
+        """
+        :param path: calibration file
+        :param import_legacy: also merge in the temperature prefixed files (eg. 21_cal.json) that
+            earlier versions wrote next to the calibration file, see load_legacy_files()
+        """
+        self.path = path
+        self.import_legacy = import_legacy
+        self.index = dict()
+        self.mtime = None
+        self.load()
+
+    def load(self):
+        self.index = dict()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as cal_file:
                 cal_dict = json.load(cal_file)
-                if mux_id in cal_dict.keys():
-                    cal_dict[mux_id].update(scale_cal)
-                else:
-                    cal_dict.setdefault(mux_id, scale_cal)
-                cal_file.seek(0)
-                cal_file.write(json.dumps(cal_dict, indent=4, sort_keys=True))
-                cal_file.truncate()
+            for mux_address in cal_dict.keys():
+                for port, entries in cal_dict[mux_address].items():
+                    if isinstance(entries, list):
+                        entries = {"default": entries}
+                    for temperature, (zero_offset, cal_factor) in entries.items():
+                        temperature = None if temperature == "default" else float(temperature)
+                        self.add(mux_address, port, zero_offset, cal_factor, temperature)
+            self.mtime = os.path.getmtime(self.path)
+        if self.import_legacy:
+            self.load_legacy_files()
+
+    def load_legacy_files(self):
+        """
+        Adds the calibrations in <temperature>_<calibration file> files as calibrations at that
+        temperature. These files were written but never read by earlier versions, so they may be
+        older than the calibration file, and once loaded they replace its calibrations without a temperature.
+        :return: None
+        """
+        directory, name = os.path.split(self.path)
+        if not os.path.isdir(directory or "."):
+            return
+        for file_name in os.listdir(directory or "."):
+            prefix = file_name[:-len(name) - 1]
+            if not file_name.endswith("_" + name) or not prefix.lstrip("-").isdigit():
+                continue
+            with open(os.path.join(directory, file_name), "r") as cal_file:
+                cal_dict = json.load(cal_file)
+            for mux_address in cal_dict.keys():
+                for port, (zero_offset, cal_factor) in cal_dict[mux_address].items():
+                    entries = self.index.get(self.get_key(mux_address, port), dict())
+                    if float(prefix) not in entries:
+                        self.add(mux_address, port, zero_offset, cal_factor, float(prefix))
+
+    def reload_if_changed(self):
+        """
+        Re-reads the calibration file if it has been modified since it was loaded.
+        :return: None
+        """
+        if os.path.exists(self.path) and os.path.getmtime(self.path) != self.mtime:
+            self.load()
+
+    @staticmethod
+    def get_mux_key(mux_address):
+        """
+        :param mux_address: multiplexer address eg. 0x70 or MuxBoard id eg. i2c-3/0x70
+        :return: the address in canonical hex form, or the id unchanged
+        """
+        if "/" in str(mux_address):
+            return str(mux_address)
+        return hex(int(str(mux_address), 16))
+
+    @staticmethod
+    def get_key(mux_address, port):
+        return CalibrationStore.get_mux_key(mux_address), str(port)
+
+    def add(self, mux_address, port, zero_offset, cal_factor, temperature=None):
+        """
+        Adds or replaces the scale's calibration at a temperature. A calibration at a known
+        temperature replaces the scale's calibration without a temperature, which is ignored from then on.
+        :param mux_address: multiplexer address eg. 0x70 or MuxBoard id
+        :param port: multiplexer port of the scale
+        :param temperature: calibration temperature, None if unknown
+        :return: None
+        """
+        entries = self.index.setdefault(self.get_key(mux_address, port), dict())
+        if temperature is not None:
+            entries.pop(None, None)
+        elif any(t is not None for t in entries):
+            return
+        entries[temperature] = (zero_offset, cal_factor)
+
+    def has_multiplexer(self, mux_address):
+        mux_key = self.get_mux_key(mux_address)
+        return any(key[0] == mux_key for key in self.index)
+
+    def has_scale(self, mux_address, port):
+        return self.get_key(mux_address, port) in self.index
+
+    def reset(self, mux_address, port):
+        """
+        Forgets every calibration of a scale, eg. after its load cell was replaced.
+        :param mux_address: multiplexer address eg. 0x70 or MuxBoard id
+        :param port: multiplexer port of the scale
+        :return: None
+        """
+        self.index.pop(self.get_key(mux_address, port), None)
+
+    def lookup(self, mux_address, port, temperature=None):
+        """
+        :param mux_address: multiplexer address eg. 0x70 or MuxBoard id
+        :param port: multiplexer port of the scale
+        :param temperature: current temperature, None if unknown
+        :return: tuple of (zero offset, calibration factor) or None if the scale is not calibrated
+        """
+        entries = self.index.get(self.get_key(mux_address, port))
+        if not entries:
+            return None
+        temperatures = sorted(t for t in entries if t is not None)
+        if not temperatures:
+            return entries[None]
+        if temperature is None:
+            # no current temperature, average the calibrations
+            return (sum(entries[t][0] for t in temperatures) / len(temperatures),
+                    sum(entries[t][1] for t in temperatures) / len(temperatures))
+        if temperature <= temperatures[0]:
+            return entries[temperatures[0]]
+        if temperature >= temperatures[-1]:
+            return entries[temperatures[-1]]
+        upper = next(t for t in temperatures if t >= temperature)
+        lower = temperatures[temperatures.index(upper) - 1]
+        fraction = (temperature - lower) / (upper - lower)
+        return tuple(low + fraction * (high - low) for low, high in zip(entries[lower], entries[upper]))
+
+    def needs_temperature(self):
+        """
+        :return: True if any scale has calibrations at more than one temperature
+        """
+        return any(len([t for t in entries if t is not None]) > 1 for entries in self.index.values())
+
+    def save(self):
+        """
+        Writes every calibration in one go, replacing the file atomically.
+        :return: None
+        """
+        cal_dict = dict()
+        for (mux_address, port), entries in self.index.items():
+            cal_dict.setdefault(mux_address, dict())[port] = {
+                ("default" if t is None else str(t)): list(entries[t]) for t in entries}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as cal_file:
+            json.dump(cal_dict, cal_file, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self.mtime = os.path.getmtime(self.path)
+
 
-        except IOError:
-            with open(file, "w+") as cal_file:
-                cal_dict = {mux_id: scale_cal}
-                json.dump(cal_dict, cal_file, indent=4, sort_keys=True)
+class ScaleSession:
+    """
+    Long lived connection to the scales. Owns one SMBus handle per bus and keeps one Scale per
+    multiplexer port so each NAU7802 is only initialised once per run.
+    """
+
+    def __init__(self, bus_number=1):
+        self.bus_number = bus_number
+        self.buses = dict()
+        self.bus = self.get_bus(bus_number)
+        self.scales = dict()
+        self.active_boards = dict()
+
+    def get_bus(self, bus_number):
+        """
+        :param bus_number: I2C bus number eg. 1 for /dev/i2c-1
+        :return: the session's SMBus handle for the bus
+        """
+        if bus_number not in self.buses:
+            self.buses[bus_number] = hardware.get_backend().open_bus(bus_number)
+        return self.buses[bus_number]
+
+    def get_scale(self, mux_board, port):
+        """
+        Returns the session's Scale for a multiplexer port, creating it on first use.
+        :param mux_board: MuxBoard the scale is attached to
+        :param port: Multiplexer port (0-7) of the scale
+        :return: Scale
+        """
+        key = (mux_board.id, int(port))
+        if key not in self.scales:
+            self.scales[key] = Scale(mux_board, port)
+        return self.scales[key]
+
+    def is_connected(self, scale):
+        """
+        Runs begin() on the scale only if it has not been initialised or its last read failed.
+        :param scale: Scale to check
+        :return: True if the scale is ready to read
+        """
+        return scale.is_connected(self.get_bus(scale.mux_board.bus_number))
+
+    def select(self, scale):
+        """
+        Selects the scale's multiplexer port, first releasing any other multiplexer on the same bus
+        since every NAU7802 answers on the same I2C address.
+        :param scale: Scale to select
+        :return: None
+        """
+        board = scale.mux_board
+        active = self.active_boards.get(board.bus_number)
+        if active is not None and active is not board:
+            active.release()
+        board.select(scale.get_port())
+        self.active_boards[board.bus_number] = board
+
+    def release(self, bus_number):
+        """
+        Releases the selected multiplexer port on a bus.
+        :param bus_number: I2C bus number
+        :return: None
+        """
+        active = self.active_boards.pop(bus_number, None)
+        if active is not None:
+            active.release()
+
+    def close(self):
+        for bus in self.buses.values():
+            bus.close()
+
+
+class ReadScheduler:
+    """
+    Samples many scales in one pass. The NAU7802s convert continuously once begun, so rather than
+    waiting out each scale's conversions in turn the scales on a bus are visited round robin and
+    whichever conversions are ready are collected. Each bus is read in its own thread, at most
+    max_workers at a time. Readings are returned in the order the scales were given.
+    """
+
+    def __init__(self, session, max_workers=4, timeout=1.0):
+        self.session = session
+        self.max_workers = max(1, int(max_workers))
+        self.timeout = timeout
+
+    def read(self, scales, samples=8):
+        """
+        :param scales: list of initialised Scales
+        :param samples: number of conversions to take from scales without their own "samples" setting
+        :return: list of Readings, None where a scale failed, in the same order as scales
+        """
+        results = [None] * len(scales)
+        groups = dict()
+        for index, scale in enumerate(scales):
+            groups.setdefault(scale.mux_board.bus_number, []).append(index)
+        workers = min(self.max_workers, len(groups))
+        if workers <= 1:
+            for bus_number, indexes in groups.items():
+                self.read_bus(bus_number, scales, indexes, samples, results)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                jobs = [executor.submit(self.read_bus, bus_number, scales, indexes, samples, results)
+                        for bus_number, indexes in groups.items()]
+                for job in jobs:
+                    job.result()
+        return results
+
+    def read_bus(self, bus_number, scales, indexes, samples, results):
+        """
+        Round robin sampling of the scales on one bus, results are written into results by index.
+        A scale is only visited once its next conversion is due, so its multiplexer port is not
+        switched to just to find no new conversion.
+        :return: None
+        """
+        pending = {i: [] for i in indexes}
+        start = time.time()
+        last_conversion = {i: start for i in indexes}
+        first_conversion = dict()
+        next_due = {i: start for i in indexes}
+        try:
+            while pending:
+                now = time.time()
+                due = [i for i in pending if next_due[i] <= now]
+                if not due:
+                    time.sleep(min(next_due[i] for i in pending) - now)
+                    continue
+                for i in due:
+                    scale = scales[i]
+                    try:
+                        self.session.select(scale)
+                        value = scale.read_conversion()
+                    except IOError as e:
+                        print("Read failed for scale on multiplexer {0} port {1}: {2}".format(
+                            scale.mux_board.id, scale.get_port(), e))
+                        scale.mark_failed()
+                        del pending[i]
+                        continue
+                    now = time.time()
+                    if value is None:
+                        if now - last_conversion[i] > self.timeout:
+                            print("Timed out reading scale on multiplexer {0} port {1}".format(
+                                scale.mux_board.id, scale.get_port()))
+                            scale.mark_failed()
+                            del pending[i]
+                        else:
+                            next_due[i] = now + scale.get_poll_interval()
+                        continue
+                    first_conversion.setdefault(i, now)
+                    last_conversion[i] = now
+                    # the conversion read was made at or before now, so the next one is ready a period later
+                    next_due[i] = now + 1.0 / scale.sample_rate
+                    pending[i].append(value)
+                    if len(pending[i]) >= (scale.samples or samples):
+                        if len(pending[i]) > 1:
+                            # the scale's own rate, from its first to its last conversion of this reading
+                            scale.record_rate(len(pending[i]) - 1, now - first_conversion[i])
+                        else:
+                            # a single conversion has no period of its own, use the whole read
+                            scale.record_rate(1, now - start)
+                        metrics.observe("scale_read_seconds", now - start, scale=scale.name)
+                        results[i] = scale.make_reading(pending.pop(i))
+        finally:
+            self.session.release(bus_number)
+            metrics.observe("stage_seconds", time.time() - start, stage="sample", bus=bus_number)
 
 
 class Experiment:
     def __init__(self, treatments):
         with open(treatments, "r") as f:
             self.treatment_dict = json.load(f)
+        if "backend" in self.treatment_dict:
+            hardware.use_backend(self.treatment_dict["backend"])
+        metrics.configure(self.treatment_dict.get("metrics"), self.treatment_dict["output_dir"])
+        self.calibration = CalibrationStore(os.path.join(self.treatment_dict["output_dir"],
+                                                         self.treatment_dict["cal_file"]),
+                                            self.treatment_dict.get("import_legacy_calibrations", False))
+        self.weight_store = None
+        self.uploader = None
+        if "weight_store" in self.treatment_dict:
+            self.weight_store = WeightStore(os.path.join(self.treatment_dict["output_dir"],
+                                                         self.treatment_dict["weight_store"]))
+        # season long binary log for range queries, see timeseries.TimeSeriesStore
+        self.timeseries = None
+        if "timeseries_dir" in self.treatment_dict:
+            self.timeseries = TimeSeriesStore(os.path.join(self.treatment_dict["output_dir"],
+                                                           self.treatment_dict["timeseries_dir"]))
+        # readings waiting to be written, flushed every "flush_cycles" cycles of write_weights
+        self.readings = ReadingBuffer()
+        self.buffered_cycles = 0
+        # latest temperatures shared with irrigation.py, read from the DS18B20 here if "temperature_sensor" is set
+        self.temperature_log = TemperatureLog(os.path.join(self.treatment_dict["output_dir"],
+                                                           self.treatment_dict.get("temperature_cache",
+                                                                                   "temperature_cache.bin")))
+        self.temperature_monitor = None
+        if self.treatment_dict.get("temperature_sensor", False):
+            self.temperature_monitor = TemperatureMonitor(self.temperature_log,
+                                                          interval=float(self.treatment_dict.get("temperature_interval",
+                                                                                                 60)))
+        # "buses": {"3": {"clock_hz": 400000}}, see the README for adding buses and setting their clock
+        buses = self.treatment_dict.get("buses", {})
+        for bus_number, bus_config in buses.items():
+            if "clock_hz" in bus_config:
+                hardware.get_backend().set_bus_clock(int(bus_number), int(bus_config["clock_hz"]))
+        self.session = ScaleSession()
+        # each bus is sampled in its own thread
+        self.scheduler = ReadScheduler(self.session, max_workers=self.treatment_dict.get("max_workers",
+                                                                                         max(4, len(buses))))
+        self.mux_boards = dict()
         self.mux_dict = dict()
 
         for i in self.treatment_dict["valves"].keys():
-            self.mux_dict.setdefault(i, MuxBoard(self.treatment_dict["valves"][i]["mux_address"]))
-        self.last_temp = self.get_last_temp(self.treatment_dict["spreadsheet"], "temperature_log")
+            self.mux_dict.setdefault(i, self.get_valve_mux_board(i))
+        self.last_temp = None
+
+    def get_current_temp(self, pending=None):
+        """
+        Returns the latest temperature in the local cache if it is less than "temperature_max_age"
+        seconds old (default 3600), otherwise a new DS18B20 reading if "temperature_sensor" is set.
+        Only without either is the temperature sheet downloaded, once per run.
+        :param pending: Future of a reading started by start_temperature_read()
+        :return: temperature
+        """
+        if pending is not None:
+            return pending.result()
+        latest = self.temperature_log.get_latest(float(self.treatment_dict.get("temperature_max_age", 3600)))
+        if latest is not None:
+            return latest[1]
+        if self.temperature_monitor is not None:
+            return self.temperature_monitor.read()
+        if self.last_temp is None:
+            self.last_temp = self.get_last_temp(self.treatment_dict["spreadsheet"], "temperature_log")
+        return self.last_temp
+
+    def start_temperature_read(self):
+        """
+        Starts a DS18B20 reading in the background if the cache has no recent temperature, so the
+        conversion overlaps initialising the scales.
+        :return: Future of the temperature, or None if no reading was started
+        """
+        if self.temperature_monitor is None:
+            return None
+        if self.temperature_log.get_latest(float(self.treatment_dict.get("temperature_max_age", 3600))) is not None:
+            return None
+        return self.temperature_monitor.read_async()
+
+    def get_mux_board(self, mux_address, bus_number=1, parent_address=None, parent_port=None):
+        """
+        Returns the single MuxBoard for an address so its selected port state stays in sync
+        with the hardware.
+        :param mux_address: multiplexer address as a hex string eg. 0x70
+        :param bus_number: I2C bus number
+        :param parent_address: address of the multiplexer this one is cascaded behind, None if directly on the bus
+        :param parent_port: port of the parent multiplexer
+        :return: MuxBoard
+        """
+        parent = None
+        if parent_address is not None:
+            parent = self.get_mux_board(parent_address, bus_number)
+            parent_port = int(parent_port)
+        key = (bus_number, parent_address and int(parent_address, 16), parent_port, int(mux_address, 16))
+        if key not in self.mux_boards:
+            self.mux_boards[key] = MuxBoard(mux_address, bus_number, parent, parent_port)
+        return self.mux_boards[key]
+
+    def get_valve_mux_board(self, valve):
+        """
+        Returns the MuxBoard of a valve's scales. Besides "mux_address" a valve can set "bus" (default 1)
+        and, for a multiplexer cascaded behind another one on the same bus, "parent_mux" and "parent_port" eg.
+        "valves": {"9": {"bus": 3, "parent_mux": "0x70", "parent_port": 2, "mux_address": "0x71", ...}}
+        :param valve: valve number as in the treatment file
+        :return: MuxBoard
+        """
+        valve_dict = self.treatment_dict["valves"][valve]
+        return self.get_mux_board(valve_dict["mux_address"], int(valve_dict.get("bus", 1)),
+                                  valve_dict.get("parent_mux"), valve_dict.get("parent_port"))
+
+    def get_mux_write_stats(self):
+        """
+        :return: tuple of (I2C writes made, I2C writes skipped) summed over all multiplexers
+        """
+        stats = [board.get_write_stats() for board in self.mux_boards.values()]
+        return sum(i[0] for i in stats), sum(i[1] for i in stats)
 
     def get_scales_dict(self, scales):
         scales_dict = dict()
@@ -136,94 +789,325 @@ class Experiment:
             for valve, mux in zip(self.treatment_dict["valves"].keys(), self.mux_dict.keys()):
                 scales_dict.setdefault(mux, {})
                 for port in self.treatment_dict["valves"][valve]["scales"]:
-                    scales_dict[mux].setdefault(port, Scale(self.mux_dict[mux], port))
+                    scales_dict[mux].setdefault(port, self.session.get_scale(self.mux_dict[mux], port))
         else:
 
             scale_list = scales.strip().split(",")
+            # multiplexers other than bus 1 ones are given by id eg. i2c-3/0x70-0, see MuxBoard.get_id()
+            valves = {board.id: valve for valve, board in self.mux_dict.items()}
             for pair in scale_list:
-                split_pair = pair.strip().split("-")
+                split_pair = pair.strip().rsplit("-", 1)
                 mux_address = split_pair[0]
                 scale = split_pair[1]
+                mux_id = CalibrationStore.get_mux_key(mux_address)
+                if mux_id in valves:
+                    mux_address = valves[mux_id]
+                    mux_board = self.mux_dict[mux_address]
+                else:
+                    mux_board = self.get_mux_board(mux_address)
                 if mux_address in scales_dict.keys():
-                    scales_dict[mux_address].setdefault(scale, Scale(MuxBoard(mux_address), scale))
+                    scales_dict[mux_address].setdefault(scale, self.session.get_scale(mux_board, scale))
                 else:
-                    scales_dict.setdefault(mux_address, {scale: Scale(MuxBoard(mux_address), scale)})
+                    scales_dict.setdefault(mux_address, {scale: self.session.get_scale(mux_board, scale)})
         return scales_dict
 
-    def calibrate_scales(self, scales):
+    def calibrate_scales(self, scales, replace=False):
+        """
+        Tares the scales and adds their calibrations at the current temperature. The scales
+        calibrated before a mistyped mass or Ctrl-C are still saved.
+        :param scales: scales to calibrate
+        :param replace: forget each scale's earlier calibrations, eg. after replacing its load cell
+        :return: None
+        """
         scales_dict = self.get_scales_dict(scales)
         print(scales_dict)
-        for mux in scales_dict.keys():
-            for scale in scales_dict[mux].keys():
-                if scales_dict[mux][scale].is_connected():
-                    print("tare scale on multiplexer {0} port {1}".format(mux, scales_dict[mux][scale].get_port()))
-                    scales_dict[mux][scale].tare_scale()
-                    cal_name = str(round(self.last_temp)) + "_"+self.treatment_dict["cal_file"]
-                    scales_dict[mux][scale].write_calibration(os.path.join(self.treatment_dict["output_dir"],
-                                                                           cal_name))
+        temperature = round(float(self.get_current_temp()), 1)
+        calibrated = 0
+        try:
+            for mux in scales_dict.keys():
+                for scale in scales_dict[mux].keys():
+                    # tare at the gain and sample rate the scale will be read at
+                    if not scales_dict[mux][scale].configured:
+                        scales_dict[mux][scale].configure(self.get_scale_config(mux, scale))
+                    if self.session.is_connected(scales_dict[mux][scale]):
+                        print("tare scale on multiplexer {0} port {1}".format(mux, scales_dict[mux][scale].get_port()))
+                        scales_dict[mux][scale].tare_scale()
+                        if replace:
+                            self.calibration.reset(scales_dict[mux][scale].mux_board.id,
+                                                   scales_dict[mux][scale].get_port())
+                        self.calibration.add(scales_dict[mux][scale].mux_board.id, scales_dict[mux][scale].get_port(),
+                                             scales_dict[mux][scale].get_zero_offset(),
+                                             scales_dict[mux][scale].get_cal_factor(), temperature)
+                        calibrated += 1
+        finally:
+            # one atomic write for the whole session, including when it is cut short
+            if calibrated:
+                self.calibration.save()
+                print("saved {0} calibration(s) at {1} C to {2}".format(calibrated, temperature,
+                                                                       self.calibration.path))
 
-    def read_weights(self, scales):
-        cal_file_path = os.path.join(self.treatment_dict["output_dir"], self.treatment_dict["cal_file"])
-        with open(cal_file_path, "r") as cal_file:
-            cal_dict = json.load(cal_file)
+    def get_calibration_temp(self, pending=None):
+        """
+        :param pending: Future of a reading started by start_temperature_read()
+        :return: current temperature if the calibrations are temperature dependent, otherwise None
+        """
+        if not self.calibration.needs_temperature():
+            return None
+        try:
+            return float(self.get_current_temp(pending))
+        except Exception as e:
+            print("Could not get temperature, using average calibration: {0}".format(e))
+            return None
+
+    def get_scale_config(self, valve, port):
+        """
+        Merges the treatment file's "scale_defaults" with the valve's "scale_config" entry for the port, eg.
+        "scale_defaults": {"filter": {"type": "ema", "alpha": 0.3, "reject": 0.05}},
+        "valves": {"1": {"scale_config": {"0": {"filter": {"type": "median", "window": 5}}}}}
+        :param valve: valve the scale belongs to
+        :param port: multiplexer port of the scale
+        :return: dictionary of scale settings
+        """
+        config = dict(self.treatment_dict.get("scale_defaults", {}))
+        config.update(self.treatment_dict["valves"][valve].get("scale_config", {}).get(str(port), {}))
+        return config
+
+    def get_calibrated_scales(self, scales):
+        """
+        Initialises the scales and applies their calibration.
+        :param scales: scales to read weights from
+        :return: list of (multiplexer, scale, Scale) for the connected scales
+        """
+        self.calibration.reload_if_changed()
+        pending = self.start_temperature_read() if self.calibration.needs_temperature() else None
         scales_dict = self.get_scales_dict(scales)
-        mux_list = []
-        scale_list = []
-        weight_list = []
-        raw_list = []
+        connected = []
         for mux in scales_dict.keys():
-            mux_address = self.treatment_dict["valves"][mux]["mux_address"]
             for scale in scales_dict[mux].keys():
-                if scales_dict[mux][scale].is_connected():
-                    print("Reading weight from scale on multiplexer {0} port {1}".format(mux, scales_dict[mux][scale].get_port()))
-                    if mux_address in cal_dict.keys():
-                        if scale in cal_dict[mux_address].keys():
-                            zero_offset = cal_dict[mux_address][scale][0]
-                            cal_factor = cal_dict[mux_address][scale][1]
-                            scales_dict[mux][scale].set_zero_offset(zero_offset)
-                            scales_dict[mux][scale].set_cal_factor(cal_factor)
-                            weight_list.append(scales_dict[mux][scale].get_weight())
-                            raw_list.append(scales_dict[mux][scale].get_average())
-                            mux_list.append(mux)
-                            scale_list.append(scale)
-                        else:
-                            print("Error: no calibration found for scale {0} at multiplexer {1}".format(scale, mux_address))
-                            exit(1)
-                    else:
-                        print("Error: no calibration found for any scale on multiplexer {0}".format(mux_address))
-                        exit(1)
-        current_time = datetime.now().isoformat()
-        timestamp = [current_time for i in range(len(scale_list))]
-        weight_df = pd.DataFrame({"Timestamp": timestamp,
-                                  "Multiplexer": mux_list,
-                                  "Scale": scale_list,
-                                  "Weight": weight_list,
-                                  "Raw": raw_list})
-        return weight_df
+                if not scales_dict[mux][scale].configured:
+                    scales_dict[mux][scale].configure(self.get_scale_config(mux, scale))
+                if not self.session.is_connected(scales_dict[mux][scale]):
+                    continue
+                print("Reading weight from scale on multiplexer {0} port {1}".format(mux, scales_dict[mux][scale].get_port()))
+                connected.append((mux, scale))
+        temperature = self.get_calibration_temp(pending)
+        selected = []
+        for mux, scale in connected:
+            mux_address = self.mux_dict[mux].id
+            if self.calibration.has_multiplexer(mux_address):
+                if self.calibration.has_scale(mux_address, scale):
+                    zero_offset, cal_factor = self.calibration.lookup(mux_address, scale, temperature)
+                    scales_dict[mux][scale].set_zero_offset(zero_offset)
+                    scales_dict[mux][scale].set_cal_factor(cal_factor)
+                    selected.append((mux, scale, scales_dict[mux][scale]))
+                else:
+                    print("Error: no calibration found for scale {0} at multiplexer {1}".format(scale, mux_address))
+                    exit(1)
+            else:
+                print("Error: no calibration found for any scale on multiplexer {0}".format(mux_address))
+                exit(1)
+        return selected
+
+    def read_scales(self, scales):
+        """
+        Reads the scales without building a DataFrame.
+        :param scales: scales to read weights from
+        :return: list of [timestamp, multiplexer, scale, weight, raw, std, samples] rows
+        """
+        buffer = ReadingBuffer()
+        self.sample_scales(scales, buffer)
+        return buffer.to_rows()
+
+    def sample_scales(self, scales, buffer):
+        """
+        Reads the scales into a ReadingBuffer.
+        :param scales: scales to read weights from
+        :param buffer: ReadingBuffer the readings are added to
+        :return: number of readings added
+        """
+        with metrics.timer("stage_seconds", stage="connect"):
+            selected = self.get_calibrated_scales(scales)
+        samples = int(self.treatment_dict.get("samples", 8))
+        with metrics.timer("stage_seconds", stage="read"):
+            readings = self.scheduler.read([i[2] for i in selected], samples)
+        writes, writes_saved = self.get_mux_write_stats()
+        print("Multiplexer I2C writes: {0}, skipped: {1}".format(writes, writes_saved))
+        print("Achieved conversions per second: {0}".format(", ".join(
+            "{0}-{1} {2}/{3}".format(mux, scale, "n/a" if scale_obj.achieved_rate is None else
+                                     "{0:.1f}".format(scale_obj.achieved_rate), scale_obj.sample_rate)
+            for (mux, scale, scale_obj), reading in zip(selected, readings) if reading is not None)))
+        return buffer.add_cycle(datetime.now(), [(mux, scale) for mux, scale, scale_obj in selected], readings)
+
+    def read_weights(self, scales):
+        buffer = ReadingBuffer()
+        self.sample_scales(scales, buffer)
+        with metrics.timer("stage_seconds", stage="dataframe"):
+            return buffer.to_dataframe(READING_COLUMNS)
 
     def write_weights(self, spreadsheet, sheet_name, scales):
-        weight_df = self.read_weights(scales)
-        gc = self.connect_to_drive()
-        sheet = gc.open(spreadsheet)
-        values = weight_df.values.tolist()
-        sheet.values_append(sheet_name,
-                            {'valueInputOption': "USER_ENTERED"},
-                            {'values': values})
+        """
+        Reads the scales and writes the readings once "flush_cycles" cycles (default 1) have been
+        buffered. Buffered readings are lost if the process dies before they are flushed, so
+        callers that stop between cycles must call flush_weights().
+        :param spreadsheet: name of Google spreadsheet
+        :param sheet_name: name of worksheet to append weights to
+        :param scales: scales to read weights from
+        :return: None
+        """
+        self.sample_scales(scales, self.readings)
+        self.buffered_cycles += 1
+        if self.buffered_cycles >= int(self.treatment_dict.get("flush_cycles", 1)):
+            self.flush_weights(spreadsheet, sheet_name)
+
+    def flush_weights(self, spreadsheet, sheet_name):
+        """
+        Writes the buffered readings to the weight store or sheet, then to the timeseries store.
+        If the weight store or sheet write fails the readings stay buffered for the next flush,
+        up to "max_buffered_readings" (default 100000) after which they are dropped. A failure to
+        write the timeseries store is logged and does not hold back the weights.
+        :param spreadsheet: name of Google spreadsheet
+        :param sheet_name: name of worksheet to append weights to
+        :return: None
+        """
+        self.buffered_cycles = 0
+        if len(self.readings) == 0:
+            return
+        values = self.readings.to_rows(len(WEIGHT_COLUMNS))
+        try:
+            if self.weight_store is None:
+                with metrics.timer("stage_seconds", stage="upload"):
+                    sheet = self.open_spreadsheet(spreadsheet)
+                    metrics.count("api_calls_total", call="values_append")
+                    sheet.values_append(sheet_name,
+                                        {'valueInputOption': "USER_ENTERED"},
+                                        {'values': values})
+            else:
+                with metrics.timer("stage_seconds", stage="store"):
+                    self.weight_store.append(values)
+        except Exception:
+            if len(self.readings) > int(self.treatment_dict.get("max_buffered_readings", 100000)):
+                print("{0}: dropping {1} buffered readings that could not be written".format(
+                    datetime.now(), len(self.readings)))
+                self.readings.clear()
+            raise
+        records = None
+        if self.timeseries is not None:
+            try:
+                records = self.readings.to_records()
+            except (ValueError, OverflowError) as e:
+                # eg. a valve or scale that is not a number, which only the timeseries store needs
+                print("{0}: weights not written to the timeseries store: {1}".format(datetime.now(), e))
+        self.readings.clear()
+        if records is not None:
+            try:
+                with metrics.timer("stage_seconds", stage="timeseries"):
+                    self.timeseries.append_records(records)
+            except OSError as e:
+                print("{0}: weights not written to the timeseries store: {1}".format(datetime.now(), e))
+        if self.weight_store is not None:
+            # readings are durable once stored, the upload happens now or in the background uploader
+            uploader = self.get_uploader(spreadsheet, sheet_name)
+            if not uploader.is_running():
+                uploader.try_flush()
+
+    def get_uploader(self, spreadsheet, sheet_name):
+        """
+        Returns the uploader copying the local weight store to the worksheet. Setting "upload_sink"
+        in the treatment file to a CSV path uploads there instead of to Google Sheets.
+        :param spreadsheet: name of Google spreadsheet
+        :param sheet_name: name of worksheet to append weights to
+        :return: Uploader
+        """
+        if self.uploader is None:
+            if "upload_sink" in self.treatment_dict:
+                sink = CsvSink(self.treatment_dict["upload_sink"])
+            else:
+                sink = SheetsSink(self.open_spreadsheet, spreadsheet, sheet_name)
+            self.uploader = Uploader(self.weight_store, sink,
+                                     batch_size=int(self.treatment_dict.get("upload_batch_size", 500)))
+        return self.uploader
 
     def connect_to_drive(self):
-        scope = ['https://spreadsheets.google.com/feeds',
-                 'https://www.googleapis.com/auth/drive']
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            self.treatment_dict["gdrive_credential"], scope)
-        gc = gspread.authorize(credentials)
+        return gdrive_client.get_gspread_client(self.treatment_dict["gdrive_credential"])
+
+    def open_spreadsheet(self, spreadsheet):
+        return gdrive_client.open_spreadsheet(self.treatment_dict["gdrive_credential"], spreadsheet)
+
+    def run_daemon(self, spreadsheet, sheet_name, scales, interval):
+        """
+        Writes weights every interval seconds, keeping the scales, calibration and Google client
+        initialised between cycles. Cycles are scheduled from a fixed start time so the sampling
+        rate does not drift, and cycles that overrun the next start time are skipped. SIGTERM
+        (eg. systemctl stop) stops the daemon like Ctrl-C, so buffered readings are still written.
+        :param spreadsheet: name of Google spreadsheet
+        :param sheet_name: name of worksheet to append weights to
+        :param scales: scales to read weights from
+        :param interval: seconds between the start of each cycle
+        :return: None
+        """
+        cycle_times = deque(maxlen=100)
+        next_run = time.monotonic()
+        cycle = 0
+        if self.weight_store is not None:
+            self.get_uploader(spreadsheet, sheet_name).start(
+                interval=float(self.treatment_dict.get("upload_interval", 60)))
+        if self.temperature_monitor is not None:
+            self.temperature_monitor.start()
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGTERM, self.stop_daemon)
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    self.write_weights(spreadsheet, sheet_name, scales)
+                except Exception as e:
+                    # keep sampling through transient I2C and network errors
+                    print("{0}: cycle {1} failed: {2}".format(datetime.now(), cycle, e))
+                elapsed = time.monotonic() - start
+                cycle_times.append(elapsed)
+                cycle += 1
+                metrics.observe("cycle_seconds", elapsed)
+                metrics.write_json()
+                print("{0}: cycle {1} took {2:.3f} s (min {3:.3f}, mean {4:.3f}, max {5:.3f} over last {6})".format(
+                    datetime.now(), cycle, elapsed, min(cycle_times), sum(cycle_times) / len(cycle_times),
+                    max(cycle_times), len(cycle_times)))
+                next_run += interval
+                now = time.monotonic()
+                if now > next_run:
+                    missed = int((now - next_run) // interval) + 1
+                    print("{0}: cycle overran interval, skipping {1} cycle(s)".format(datetime.now(), missed))
+                    next_run += missed * interval
+                time.sleep(max(0.0, next_run - time.monotonic()))
+        except KeyboardInterrupt:
+            print("{0}: stopping after {1} cycles".format(datetime.now(), cycle))
+        finally:
+            try:
+                self.flush_weights(spreadsheet, sheet_name)
+            except Exception as e:
+                print("{0}: writing buffered weights failed: {1}".format(datetime.now(), e))
+            if previous_handler is not None:
+                signal.signal(signal.SIGTERM, previous_handler)
+            if self.uploader is not None:
+                self.uploader.stop()
+            if self.temperature_monitor is not None:
+                self.temperature_monitor.stop()
+            self.session.close()
 
-        return gc
+    @staticmethod
+    def stop_daemon(signum, frame):
+        """
+        SIGTERM handler of run_daemon(), ends the cycle loop the way Ctrl-C does.
+        """
+        raise KeyboardInterrupt
 
     def get_temp(self, spreadsheet, sheet_name):
-        gc = self.connect_to_drive()
-        temp = gc.open(spreadsheet).worksheet(sheet_name)
+        import pandas as pd
+        from analysis import parse_timestamps
+
+        temp = self.open_spreadsheet(spreadsheet).worksheet(sheet_name)
         temp_df = pd.DataFrame(temp.get_all_records())
-        temp_df["datetime"] = [pd.to_datetime(i) for i in temp_df["Timestamp"]]
+        temp_df["datetime"] = parse_timestamps(temp_df["Timestamp"])
         temp_df.set_index("datetime", inplace=True)
 
         return temp_df
@@ -250,9 +1134,18 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--treatment", help="path to treatments json file")
     parser.add_argument("-s", "--scales", help="scales to read weights from (multiplexer address - scale) \n"
-                                                  "eg. 0x70-0,0x71-2 set to all to read all scales", default="all")
+                                                  "eg. 0x70-0,0x71-2,i2c-3/0x70-0 set to all to read all scales",
+                        default="all")
     parser.add_argument("-c", "--calibrate", help="scales to calibrate (multiplexer address - scale) \n"
-                                                  "eg. 0x70-0,0x71-2 set to all to calibrate all scales", default=None)
+                                                  "eg. 0x70-0,0x71-2,i2c-3/0x70-0 set to all to calibrate all scales",
+                        default=None)
+    parser.add_argument("--replace", help="with --calibrate, forget the scales' earlier calibrations "
+                                          "eg. after replacing a load cell", action="store_true")
+    parser.add_argument("-d", "--daemon", help="keep running and write weights every --interval seconds",
+                        action="store_true")
+    parser.add_argument("-i", "--interval", help="seconds between weight readings in daemon mode",
+                        type=float, default=60)
+    parser.add_argument("-r", "--raw", help="print readings without uploading them", action="store_true")
     args = parser.parse_args()
     treatment_file = args.treatment
     calibrate = args.calibrate
@@ -260,12 +1153,23 @@ def main():
     print("{0}:########Starting Qwiic scales#########\n".format(datetime.now()))
     my_experiment = Experiment(treatment_file)
     if calibrate is not None:
-        my_experiment.calibrate_scales(calibrate)
+        my_experiment.calibrate_scales(calibrate, replace=args.replace)
+    elif args.raw:
+        for row in my_experiment.read_scales(scales):
+            print("\t".join(str(i) for i in row))
+    elif args.daemon:
+        my_experiment.run_daemon(spreadsheet=my_experiment.treatment_dict["spreadsheet"],
+                                 sheet_name=my_experiment.treatment_dict["sheet_name"],
+                                 scales=scales,
+                                 interval=args.interval)
     else:
         my_experiment.write_weights(spreadsheet=my_experiment.treatment_dict["spreadsheet"],
                                     sheet_name=my_experiment.treatment_dict["sheet_name"],
                                     scales=scales)
-
+        # a single run writes its readings even if "flush_cycles" would buffer them
+        my_experiment.flush_weights(spreadsheet=my_experiment.treatment_dict["spreadsheet"],
+                                    sheet_name=my_experiment.treatment_dict["sheet_name"])
+    metrics.write_json()
     print("finished")
 
 
@@ -0,0 +1,36 @@
+import pandas as pd
+
+# datetime.isoformat() as written by Qwiic_scales.py and irrigation.py
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def parse_timestamps(values):
+    """
+    Parses a column of ISO format timestamps in one call with a fixed format.
+    :param values: Series or list of timestamp strings
+    :return: Series of datetimes with the same index as values
+    """
+    values = pd.Series(values)
+    parsed = pd.to_datetime(values, format=TIMESTAMP_FORMAT, errors="coerce")
+    missing = parsed.isna() & values.notna()
+    if missing.any():
+        # isoformat() leaves out the fraction when microseconds are zero
+        parsed[missing] = pd.to_datetime(values[missing], format="%Y-%m-%dT%H:%M:%S", errors="coerce")
+        missing = parsed.isna() & values.notna()
+        if missing.any():
+            parsed[missing] = pd.to_datetime(values[missing])
+    return parsed
+
+
+def water_lost_by_valve(weight_df, since=None):
+    """
+    Computes the mean water lost per pot for each valve from the first and last weight of each scale.
+    :param weight_df: DataFrame with Timestamp, Multiplexer, Scale and Weight (kg) columns in the order logged
+    :param since: only use weights logged after this datetime
+    :return: Series of mean water lost in ml indexed by valve (Multiplexer)
+    """
+    if since is not None:
+        weight_df = weight_df.loc[parse_timestamps(weight_df["Timestamp"]) > since]
+    weights = weight_df.groupby(["Multiplexer", "Scale"], sort=False)["Weight"]
+    lost = (weights.first() - weights.last()) * 1000
+    return lost.groupby(level="Multiplexer", sort=False).mean()
@@ -0,0 +1,191 @@
+"""
+Benchmark of the scale and valve hot paths on a simulated rack.
+
+Runs Qwiic_scales and irrigation against hardware.SimulatedBackend for racks of 8 to 256 scales
+(8 scales per multiplexer, one valve per multiplexer) spread over --buses I2C buses, with the
+multiplexers either directly on each bus or cascaded behind a parent multiplexer, and reports,
+per rack size:
+    calibrate s   calibrate_scales for every scale, the mass prompt answered immediately
+    read s        mean read_scales time, ie. the sampling latency of a cycle
+    cycle s       mean and p95 write_weights time into a local weight store and CSV upload sink,
+                  ie. the end-to-end latency from the first conversion to the uploaded row
+    I2C/scale     I2C transactions per scale per cycle, multiplexer writes included
+    water err ms  worst difference between requested and simulated valve open time in water_pots
+No Pi, sensors or Google account are needed. By default racks use as few buses as hold them, 64
+scales per bus with multiplexers directly on the bus and 448 with cascades.
+
+usage: python benchmarks/bench_rack.py --scales 8,32,64,128,256 --buses 4 --topology flat --cases read,water
+"""
+import argparse
+import builtins
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import hardware  # noqa: E402
+import irrigation  # noqa: E402
+import Qwiic_scales  # noqa: E402
+
+SCALES_PER_MUX = 8
+
+
+def get_mux_slots(topology):
+    """
+    :return: list of (parent address, parent port, address) for the multiplexers of one bus
+    """
+    if topology == "cascade":
+        return [(0x70, parent_port, 0x71 + i) for parent_port in range(8) for i in range(7)]
+    return [(None, None, 0x70 + i) for i in range(8)]
+
+
+def make_rack(directory, backend, scales, samples, buses, topology="flat", clock_hz=100000):
+    """
+    Writes a treatment file and a calibration matching the simulated scales.
+    :return: path of the treatment file
+    """
+    valves = dict()
+    cal_dict = dict()
+    slots = get_mux_slots(topology)
+    for valve in range((scales + SCALES_PER_MUX - 1) // SCALES_PER_MUX):
+        bus_number = valve % buses + 1
+        parent_address, parent_port, address = slots[valve // buses]
+        ports = [str(i) for i in range(min(SCALES_PER_MUX, scales - valve * SCALES_PER_MUX))]
+        valves[str(valve + 1)] = {"bus": bus_number, "mux_address": hex(address), "scales": ports,
+                                  "valve_number": valve + 1, "valve_pin": 5 + valve, "amount": 1.0}
+        # calibration keys follow Qwiic_scales.MuxBoard.get_id()
+        mux_id = hex(address) if bus_number == 1 else "i2c-{0}/{1}".format(bus_number, hex(address))
+        parent_key = None
+        if parent_address is not None:
+            valves[str(valve + 1)].update({"parent_mux": hex(parent_address), "parent_port": parent_port})
+            parent_id = hex(parent_address) if bus_number == 1 else "i2c-{0}/{1}".format(bus_number,
+                                                                                      hex(parent_address))
+            mux_id = "{0}/{1}/{2}".format(parent_id, parent_port, hex(address))
+            parent_key = hardware.mux_key(parent_address, bus_number)
+        key = hardware.mux_key(address, bus_number, parent_key, parent_port)
+        cal_dict[mux_id] = {port: [backend.get_offset(key, int(port)), backend.counts_per_kg] for port in ports}
+    with open(os.path.join(directory, "cal.json"), "w") as f:
+        json.dump(cal_dict, f)
+    treatment = {"valves": valves, "output_dir": directory, "cal_file": "cal.json", "backend": "simulated",
+                 "buses": {str(i + 1): {"clock_hz": clock_hz} for i in range(buses)},
+                 "samples": samples, "weight_store": "weights.db",
+                 "upload_sink": os.path.join(directory, "uploaded.csv"),
+                 "spreadsheet": "bench", "sheet_name": "weights", "gdrive_credential": "unused"}
+    path = os.path.join(directory, "treatment.json")
+    with open(path, "w") as f:
+        json.dump(treatment, f)
+    return path
+
+
+def bench_calibrate(experiment, backend):
+    """
+    :return: seconds to calibrate every scale
+    """
+    # every scale has an offset from make_rack(), loads only once the scale has been read
+    for (key, port) in list(backend.offsets):
+        backend.set_load(key, port, 0.0)
+
+    def place_mass(prompt):
+        # the prompt is shown with only the scale being calibrated selected
+        for bus in backend.buses.values():
+            for mux, port in bus.enabled_channels():
+                backend.set_load(mux.key, port, 1.0)
+        return "1.0"
+
+    experiment.last_temp = 21.0
+    real_input = builtins.input
+    builtins.input = place_mass
+    try:
+        start = time.perf_counter()
+        experiment.calibrate_scales("all")
+        return time.perf_counter() - start
+    finally:
+        builtins.input = real_input
+
+
+def bench_read(experiment, backend, cycles):
+    """
+    :return: tuple of (mean read_scales seconds, list of write_weights seconds, I2C transactions per cycle)
+    """
+    experiment.read_scales("all")
+    reads = []
+    for i in range(cycles):
+        start = time.perf_counter()
+        experiment.read_scales("all")
+        reads.append(time.perf_counter() - start)
+    writes = []
+    transactions = backend.get_transactions()
+    for i in range(cycles):
+        start = time.perf_counter()
+        experiment.write_weights("bench", "weights", "all")
+        writes.append(time.perf_counter() - start)
+    return statistics.mean(reads), writes, (backend.get_transactions() - transactions) / cycles
+
+
+def bench_water(treatment_file):
+    """
+    :return: worst difference in ms between the requested and the simulated open time of a valve
+    """
+    experiment = irrigation.Experiment(treatment_file)
+    amount = 3.0
+    experiment.get_water_amount = lambda: {valve: amount for valve in experiment.treatment_dict["valves"]}
+    experiment.write_water_data = lambda spreadsheet, water_amount: None
+    gpio = irrigation.GPIO
+    first_event = len(gpio.events)
+    experiment.water_pots("bench")
+    opened = dict()
+    errors = []
+    for event_time, channel, value in gpio.events[first_event:]:
+        if value == gpio.HIGH:
+            opened.setdefault(channel, event_time)
+        elif channel in opened and channel != 21:
+            errors.append(abs(event_time - opened.pop(channel) - amount / experiment.flow_rates.get_rate(None)))
+    return max(errors) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--scales", help="comma separated rack sizes", default="8,16,32,64,128,256")
+    parser.add_argument("-c", "--cycles", help="timed cycles per rack size", type=int, default=5)
+    parser.add_argument("-n", "--samples", help="conversions per reading", type=int, default=8)
+    parser.add_argument("-l", "--latency", help="simulated seconds per I2C transaction", type=float, default=0.0003)
+    parser.add_argument("-b", "--buses", help="I2C buses, 0 for as few as hold the rack", type=int, default=0)
+    parser.add_argument("-t", "--topology", help="flat or cascade", choices=["flat", "cascade"], default="flat")
+    parser.add_argument("--clock", help="bus clock in Hz", type=int, default=100000)
+    parser.add_argument("--cases", help="comma separated cases to run", default="read,calibrate,water")
+    args = parser.parse_args()
+    cases = args.cases.split(",")
+    print("{0:>6} {1:>5} {2:>12} {3:>8} {4:>12} {5:>12} {6:>10} {7:>13}".format(
+        "scales", "buses", "calibrate s", "read s", "cycle s", "cycle p95 s", "I2C/scale", "water err ms"))
+    for scales in [int(i) for i in args.scales.split(",")]:
+        per_bus = SCALES_PER_MUX * len(get_mux_slots(args.topology))
+        buses = args.buses or (scales + per_bus - 1) // per_bus
+        backend = hardware.use_backend(hardware.SimulatedBackend(i2c_latency=args.latency, seed=0))
+        calibrate = read = cycle = p95 = per_scale = water = float("nan")
+        with tempfile.TemporaryDirectory() as directory:
+            treatment_file = make_rack(directory, backend, scales, args.samples, buses, args.topology, args.clock)
+            with contextlib.redirect_stdout(io.StringIO()):
+                experiment = Qwiic_scales.Experiment(treatment_file)
+                if "calibrate" in cases:
+                    calibrate = bench_calibrate(experiment, backend)
+                if "read" in cases:
+                    read, writes, transactions = bench_read(experiment, backend, args.cycles)
+                    cycle = statistics.mean(writes)
+                    p95 = sorted(writes)[min(len(writes) - 1, int(0.95 * len(writes)))]
+                    per_scale = transactions / scales
+                experiment.session.close()
+                if experiment.weight_store is not None:
+                    experiment.weight_store.close()
+                if "water" in cases:
+                    water = bench_water(treatment_file)
+        print("{0:>6} {1:>5} {2:>12.3f} {3:>8.3f} {4:>12.3f} {5:>12.3f} {6:>10.1f} {7:>13.2f}".format(
+            scales, buses, calibrate, read, cycle, p95, per_scale, water))
+
+
+if __name__ == "__main__":
+    main()
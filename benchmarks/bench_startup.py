@@ -0,0 +1,62 @@
+"""
+Startup time of the command line entry points.
+
+Each case is run in a fresh interpreter and timed, and the heavy modules it loaded are listed.
+The hardware-only paths should not load pandas, gspread or oauth2client. Run on the Pi:
+
+usage: python benchmarks/bench_startup.py --repeat 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HEAVY_MODULES = ["pandas", "numpy", "gspread", "oauth2client", "pydrive", "qwiic"]
+
+CASES = [
+    ("python baseline", "pass"),
+    ("import pandas + gspread + oauth2client", "import pandas, gspread, oauth2client.service_account"),
+    ("import Qwiic_scales", "import Qwiic_scales"),
+    ("import irrigation", "import irrigation"),
+    ("import sync_data", "import sync_data"),
+]
+
+
+def run_case(code):
+    """
+    :return: tuple of (seconds, list of heavy modules loaded) or (None, error message)
+    """
+    report = "import sys; print(','.join(m for m in {0!r} if m in sys.modules))".format(HEAVY_MODULES)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", "{0}\n{1}".format(code, report)], cwd=ROOT,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    return elapsed, result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--repeat", help="runs per case", type=int, default=5)
+    args = parser.parse_args()
+    print("{0:<42} {1:>10}  {2}".format("case", "median s", "heavy modules loaded"))
+    for name, code in CASES:
+        times = []
+        loaded = ""
+        for i in range(args.repeat):
+            elapsed, loaded = run_case(code)
+            if elapsed is None:
+                break
+            times.append(elapsed)
+        if not times:
+            print("{0:<42} {1:>10}  {2}".format(name, "failed", loaded))
+        else:
+            print("{0:<42} {1:>10.3f}  {2}".format(name, statistics.median(times), loaded or "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark of the binary weight log against a CSV log of the same readings.
+
+Writes --days of readings from --scales scales every --interval seconds to a TimeSeriesStore and to
+a CSV file, then times a one hour query for four scales on the last day from each, and reports the
+size on disk.
+
+usage: python benchmarks/bench_timeseries.py --days 30 --scales 64 --interval 60
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from timeseries import TimeSeriesStore  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--days", help="days of readings", type=int, default=30)
+    parser.add_argument("-s", "--scales", help="scales in the rack", type=int, default=64)
+    parser.add_argument("-i", "--interval", help="seconds between readings", type=int, default=60)
+    args = parser.parse_args()
+    start = datetime(2021, 5, 1)
+    cycles = args.days * 86400 // args.interval
+    with tempfile.TemporaryDirectory() as directory:
+        store = TimeSeriesStore(os.path.join(directory, "timeseries"))
+        csv_path = os.path.join(directory, "weights.csv")
+        binary_time = csv_time = 0.0
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Timestamp", "Multiplexer", "Scale", "Weight", "Raw"])
+            for cycle in range(cycles):
+                timestamp = (start + timedelta(seconds=cycle * args.interval)).isoformat()
+                rows = [[timestamp, scale // 8 + 1, scale % 8, 2.0 - cycle * 1e-5, 40000.0 + cycle]
+                        for scale in range(args.scales)]
+                tick = time.perf_counter()
+                store.append(rows)
+                binary_time += time.perf_counter() - tick
+                tick = time.perf_counter()
+                writer.writerows(rows)
+                csv_time += time.perf_counter() - tick
+        binary_size = sum(os.path.getsize(os.path.join(store.directory, i)) for i in os.listdir(store.directory))
+        query_start = start + timedelta(days=args.days - 1, hours=12)
+        query_end = query_start + timedelta(hours=1)
+        scales = [(1, 0), (1, 1), (2, 0), (2, 1)]
+
+        tick = time.perf_counter()
+        records = store.query(query_start, query_end, scales)
+        binary_query = time.perf_counter() - tick
+
+        tick = time.perf_counter()
+        weight_df = pd.read_csv(csv_path, parse_dates=["Timestamp"])
+        selected = weight_df.loc[(weight_df["Timestamp"] >= query_start) & (weight_df["Timestamp"] < query_end) &
+                                 weight_df[["Multiplexer", "Scale"]].apply(tuple, axis=1).isin(scales)]
+        csv_query = time.perf_counter() - tick
+        assert len(selected) == len(records)
+        csv_size = os.path.getsize(csv_path)
+
+    print("{0} readings".format(cycles * args.scales))
+    print("{0:>8} {1:>10} {2:>10} {3:>12}".format("format", "size MB", "append s", "query s"))
+    print("{0:>8} {1:>10.1f} {2:>10.2f} {3:>12.4f}".format("binary", binary_size / 1e6, binary_time, binary_query))
+    print("{0:>8} {1:>10.1f} {2:>10.2f} {3:>12.4f}".format("csv", csv_size / 1e6, csv_time,
+                                                           csv_query))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark of the water loss computation used by irrigation.py.
+
+Compares the vectorised analysis.water_lost_by_valve with the previous per-row timestamp
+parsing and per-group loop on synthetic weight logs.
+
+usage: python benchmarks/bench_water_loss.py --rows 10000,100000,1000000,5000000 --legacy-max 100000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from analysis import water_lost_by_valve  # noqa: E402
+
+
+def make_weight_log(rows, valves=8, scales=8):
+    """
+    :return: DataFrame shaped like the weight worksheet with rows readings of valves x scales pots
+    """
+    pots = valves * scales
+    cycles = rows // pots + 1
+    start = datetime(2021, 5, 1)
+    times = [(start + timedelta(minutes=5 * i)).isoformat(timespec="microseconds") for i in range(cycles)]
+    rng = np.random.default_rng(0)
+    weight_df = pd.DataFrame({"Timestamp": np.repeat(times, pots)[:rows],
+                              "Multiplexer": np.tile(np.repeat(np.arange(1, valves + 1), scales), cycles)[:rows],
+                              "Scale": np.tile(np.arange(scales), valves * cycles)[:rows],
+                              "Weight": rng.normal(2.0, 0.05, rows)})
+    weight_df["Raw"] = weight_df["Weight"] * 20000
+    return weight_df, pd.Timestamp(times[len(times) // 2])
+
+
+def legacy_water_lost(weight_df, last_watering):
+    weight_df["datetime"] = [pd.to_datetime(i) for i in weight_df["Timestamp"]]
+    recent_weight = weight_df.loc[weight_df["datetime"] > last_watering]
+    water_lost = dict()
+    for group in recent_weight.groupby(["Multiplexer", "Scale"]):
+        prev_weight = (group[1].loc[min(group[1].index), "Weight"]) * 1000
+        cur_weight = (group[1].loc[max(group[1].index), "Weight"]) * 1000
+        diff = prev_weight - cur_weight
+        water_lost.setdefault(group[0][0], []).append(diff)
+    return {valve: sum(diffs) / len(diffs) for valve, diffs in water_lost.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--rows", help="comma separated log sizes", default="10000,100000,1000000")
+    parser.add_argument("-l", "--legacy-max", help="largest log size to run the legacy loop on",
+                        type=int, default=100000)
+    args = parser.parse_args()
+    print("{0:>10} {1:>14} {2:>14} {3:>10}".format("rows", "vectorised s", "legacy s", "speedup"))
+    for rows in [int(i) for i in args.rows.split(",")]:
+        weight_df, last_watering = make_weight_log(rows)
+        start = time.perf_counter()
+        result = water_lost_by_valve(weight_df, since=last_watering)
+        vectorised = time.perf_counter() - start
+        legacy = float("nan")
+        if rows <= args.legacy_max:
+            start = time.perf_counter()
+            expected = legacy_water_lost(weight_df.copy(), last_watering)
+            legacy = time.perf_counter() - start
+            assert np.allclose([expected[v] for v in result.index], result.values)
+        print("{0:>10} {1:>14.3f} {2:>14.3f} {3:>10.1f}".format(rows, vectorised, legacy, legacy / vectorised))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import bisect
+from collections import deque
+
+
+class MedianFilter:
+    """
+    Rolling median of the last window samples.
+    """
+
+    def __init__(self, window=5):
+        self.window = int(window)
+        self.samples = deque()
+        self.ordered = []
+        self.value = None
+
+    def update(self, sample):
+        """
+        :param sample: new sample
+        :return: filtered value
+        """
+        if len(self.samples) == self.window:
+            del self.ordered[bisect.bisect_left(self.ordered, self.samples.popleft())]
+        self.samples.append(sample)
+        bisect.insort(self.ordered, sample)
+        middle = len(self.ordered) // 2
+        if len(self.ordered) % 2:
+            self.value = self.ordered[middle]
+        else:
+            self.value = (self.ordered[middle - 1] + self.ordered[middle]) / 2
+        return self.value
+
+
+class TrimmedMeanFilter(MedianFilter):
+    """
+    Rolling mean of the last window samples after dropping the trim fraction at each end.
+    """
+
+    def __init__(self, window=10, trim=0.2):
+        super().__init__(window)
+        self.trim = float(trim)
+
+    def update(self, sample):
+        super().update(sample)
+        cut = int(len(self.ordered) * self.trim)
+        kept = self.ordered[cut:len(self.ordered) - cut]
+        self.value = sum(kept) / len(kept)
+        return self.value
+
+
+class EmaFilter:
+    """
+    Exponential moving average. Samples further than reject from the current value are ignored
+    as outliers, unless max_rejects arrive in a row, which is taken as a real step in weight
+    (eg. after watering) and restarts the average from the new level.
+    """
+
+    def __init__(self, alpha=0.3, reject=None, max_rejects=3):
+        self.alpha = float(alpha)
+        self.reject = reject
+        self.max_rejects = int(max_rejects)
+        self.rejected = []
+        self.value = None
+
+    def update(self, sample):
+        if self.value is None:
+            self.value = sample
+        elif self.reject is not None and abs(sample - self.value) > self.reject:
+            self.rejected.append(sample)
+            if len(self.rejected) >= self.max_rejects:
+                self.value = sum(self.rejected) / len(self.rejected)
+                self.rejected = []
+        else:
+            self.rejected = []
+            self.value += self.alpha * (sample - self.value)
+        return self.value
+
+
+FILTERS = {"median": MedianFilter,
+           "trimmed_mean": TrimmedMeanFilter,
+           "ema": EmaFilter}
+
+
+def make_filter(config):
+    """
+    Builds a filter from its treatment file settings eg. {"type": "median", "window": 5}.
+    :param config: dictionary with the filter type and its keyword arguments, or None
+    :return: filter or None
+    """
+    if not config:
+        return None
+    config = dict(config)
+    filter_type = config.pop("type")
+    if filter_type not in FILTERS:
+        raise ValueError("unknown filter type {0}, expected one of {1}".format(filter_type, ", ".join(FILTERS)))
+    return FILTERS[filter_type](**config)
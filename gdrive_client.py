@@ -0,0 +1,85 @@
+import threading
+from metrics import metrics
+
+# gspread, oauth2client and PyDrive are imported on first use so the hardware-only
+# paths of the scripts start without loading them
+
+SHEETS_SCOPE = ['https://spreadsheets.google.com/feeds',
+                'https://www.googleapis.com/auth/drive']
+DRIVE_SCOPE = ['https://www.googleapis.com/auth/drive']
+
+# Clients are shared by every caller in the process, keyed by credential file (and scope)
+_lock = threading.RLock()
+_credentials = dict()
+_gspread_clients = dict()
+_spreadsheets = dict()
+_drives = dict()
+
+
+def get_credentials(credential, scope=SHEETS_SCOPE):
+    """
+    Loads service account credentials once per process.
+    :param credential: path to client_secret.json file
+    :param scope: list of OAuth scopes
+    :return: ServiceAccountCredentials
+    """
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    key = (credential, tuple(scope))
+    with _lock:
+        if key not in _credentials:
+            _credentials[key] = ServiceAccountCredentials.from_json_keyfile_name(credential, scope)
+        return _credentials[key]
+
+
+def get_gspread_client(credential):
+    """
+    Returns the process wide gspread client, authorising on first use. The client's HTTP session
+    is reused between calls and the access token is only refreshed once it has expired.
+    :param credential: path to client_secret.json file
+    :return: gspread client
+    """
+    import gspread
+
+    with _lock:
+        credentials = get_credentials(credential)
+        if credential not in _gspread_clients:
+            metrics.count("api_calls_total", call="authorize")
+            _gspread_clients[credential] = gspread.authorize(credentials)
+        elif credentials.access_token_expired:
+            metrics.count("api_calls_total", call="login")
+            _gspread_clients[credential].login()
+        return _gspread_clients[credential]
+
+
+def open_spreadsheet(credential, spreadsheet):
+    """
+    Opens a spreadsheet once per process.
+    :param credential: path to client_secret.json file
+    :param spreadsheet: name of Google spreadsheet
+    :return: gspread Spreadsheet
+    """
+    with _lock:
+        gc = get_gspread_client(credential)
+        key = (credential, spreadsheet)
+        if key not in _spreadsheets:
+            metrics.count("api_calls_total", call="open")
+            _spreadsheets[key] = gc.open(spreadsheet)
+        return _spreadsheets[key]
+
+
+def get_drive(credential):
+    """
+    Returns the process wide PyDrive connection.
+    :param credential: path to client_secret.json file
+    :return: GoogleDrive instance
+    """
+    from pydrive.auth import GoogleAuth
+    from pydrive.drive import GoogleDrive
+
+    with _lock:
+        if credential not in _drives:
+            gauth = GoogleAuth()
+            gauth.credentials = get_credentials(credential, DRIVE_SCOPE)
+            _drives[credential] = GoogleDrive(gauth)
+        return _drives[credential]
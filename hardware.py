@@ -0,0 +1,456 @@
+import os
+import random
+import threading
+import time
+
+# Set to "simulated" to run the scripts without a Pi, eg. QWIIC_BACKEND=simulated python3 Qwiic_scales.py ...
+BACKEND_ENV = "QWIIC_BACKEND"
+
+# Standard mode I2C clock, the Pi's default for /dev/i2c-1
+DEFAULT_CLOCK_HZ = 100000
+
+
+def read_bus_clock(bus_number):
+    """
+    Reads a bus' clock from the device tree, set by dtparam=i2c_arm_baudrate or the i2c-gpio overlay.
+    :param bus_number: I2C bus number eg. 1 for /dev/i2c-1
+    :return: clock in Hz or None if it cannot be read
+    """
+    path = "/sys/class/i2c-adapter/i2c-{0}/of_node/clock-frequency".format(bus_number)
+    try:
+        with open(path, "rb") as f:
+            return int.from_bytes(f.read(4), "big")
+    except (IOError, ValueError):
+        return None
+
+
+class HardwareBackend:
+    """
+    The real devices: SMBus, the Qwiic TCA9548A and NAU7802 drivers, RPi.GPIO and the DS18B20.
+    Driver modules are imported on first use.
+    """
+    name = "hardware"
+
+    def open_bus(self, bus_number):
+        import smbus2
+
+        return smbus2.SMBus(bus_number)
+
+    def make_mux(self, address, bus_number=1, parent=None, parent_port=None):
+        """
+        Routing through a parent multiplexer is done by MuxBoard, the driver only needs the bus.
+        """
+        import qwiic_tca9548a
+
+        if bus_number == 1:
+            return qwiic_tca9548a.QwiicTCA9548A(address=address)
+        import qwiic_i2c
+
+        return qwiic_tca9548a.QwiicTCA9548A(address=address, i2c_driver=qwiic_i2c.getI2CDriver(iBus=bus_number))
+
+    def set_mux_channels(self, mux, mask):
+        """
+        Writes the TCA9548A control register in one I2C transaction, unlike the driver's
+        enable_channels() and disable_channels() which read it first.
+        :param mux: QwiicTCA9548A
+        :param mask: bit mask of the channels to enable
+        :return: None
+        """
+        mux._i2c.writeCommand(mux.address, mask)
+
+    def make_adc(self, mux, port):
+        import PyNAU7802
+
+        return PyNAU7802.NAU7802()
+
+    def get_gpio(self):
+        import RPi.GPIO as GPIO
+
+        return GPIO
+
+    def make_thermometer(self):
+        from w1thermsensor import W1ThermSensor
+
+        return W1ThermSensor()
+
+    def set_bus_clock(self, bus_number, clock_hz):
+        """
+        The clock of a Linux I2C bus is fixed when the kernel loads its driver, so this only checks
+        the configured clock and explains how to change it.
+        :return: None
+        """
+        actual = read_bus_clock(bus_number)
+        if actual is not None and actual != clock_hz:
+            print("Warning: /dev/i2c-{0} runs at {1} Hz, not {2} Hz. Set dtparam=i2c_arm_baudrate={2} "
+                  "(bus 1) or i2c_gpio_delay_us in the i2c-gpio overlay (software buses) in /boot/config.txt "
+                  "and reboot".format(bus_number, actual, clock_hz))
+
+
+class SimulatedBackend:
+    """
+    Software model of the rack. Every I2C transaction takes i2c_latency seconds at 100 kHz, scaled
+    by each bus' clock, and transactions on the same bus are serialised, the NAU7802s produce a conversion every 1 / sample rate seconds
+    with gaussian noise, and reading a scale while a channel on another multiplexer of the same
+    bus is enabled fails as the shared 0x2A address would on real hardware.
+    """
+    name = "simulated"
+
+    def __init__(self, i2c_latency=0.0003, noise=30, counts_per_kg=20000, thermometer_time=0.75, seed=None):
+        """
+        :param i2c_latency: seconds per I2C transaction, about 0.3 ms for a short transfer at 100 kHz
+        :param noise: standard deviation of a conversion in ADC counts
+        :param counts_per_kg: ADC counts per kg at x128 gain
+        :param thermometer_time: seconds per DS18B20 conversion
+        :param seed: random seed
+        """
+        self.i2c_latency = i2c_latency
+        self.noise = noise
+        self.counts_per_kg = counts_per_kg
+        self.thermometer_time = thermometer_time
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.bus_locks = dict()
+        self.bus_clocks = dict()
+        self.buses = dict()
+        self.transactions = dict()
+        self.loads = dict()
+        self.offsets = dict()
+        self.gpio = SimulatedGPIO()
+        self.temperature = 21.0
+
+    def transaction(self, bus_number, count=1):
+        """
+        Models count I2C transactions on a bus.
+        :return: None
+        """
+        with self.lock:
+            bus_lock = self.bus_locks.setdefault(bus_number, threading.Lock())
+            self.transactions[bus_number] = self.transactions.get(bus_number, 0) + count
+            latency = self.i2c_latency * DEFAULT_CLOCK_HZ / self.bus_clocks.get(bus_number, DEFAULT_CLOCK_HZ)
+        with bus_lock:
+            if latency:
+                time.sleep(latency * count)
+
+    def set_bus_clock(self, bus_number, clock_hz):
+        with self.lock:
+            self.bus_clocks[bus_number] = clock_hz
+
+    def get_transactions(self):
+        """
+        :return: total I2C transactions on every bus
+        """
+        with self.lock:
+            return sum(self.transactions.values())
+
+    def get_offset(self, mux_key, port):
+        """
+        :param mux_key: multiplexer key, see mux_key()
+        :param port: multiplexer port of the scale
+        :return: ADC reading of the scale with nothing on it
+        """
+        with self.lock:
+            return self.offsets.setdefault((mux_key, port), self.random.randint(-200000, 200000))
+
+    def set_load(self, mux_key, port, kg):
+        with self.lock:
+            self.loads[(mux_key, port)] = kg
+
+    def get_load(self, mux_key, port):
+        with self.lock:
+            return self.loads.setdefault((mux_key, port), self.random.uniform(1.0, 3.0))
+
+    def get_bus(self, bus_number):
+        with self.lock:
+            return self.buses.setdefault(bus_number, SimulatedBus(self, bus_number))
+
+    def open_bus(self, bus_number):
+        return self.get_bus(bus_number)
+
+    def make_mux(self, address, bus_number=1, parent=None, parent_port=None):
+        """
+        :param parent: SimulatedMux this one is wired behind, None if it is directly on the bus
+        :param parent_port: port of the parent multiplexer
+        """
+        mux = SimulatedMux(self, address, self.get_bus(bus_number), parent, parent_port)
+        self.get_bus(bus_number).muxes.append(mux)
+        return mux
+
+    def set_mux_channels(self, mux, mask):
+        mux.set_channels(mask)
+
+    def make_adc(self, mux, port):
+        return SimulatedNAU7802(self, mux, port)
+
+    def get_gpio(self):
+        return self.gpio
+
+    def make_thermometer(self):
+        return SimulatedThermometer(self)
+
+
+class SimulatedBus:
+    def __init__(self, backend, bus_number):
+        self.backend = backend
+        self.bus_number = bus_number
+        self.muxes = []
+
+    def enabled_channels(self):
+        """
+        :return: list of (multiplexer, port) for the scale ports reachable from the bus
+        """
+        cascades = {(mux.parent, mux.parent_port) for mux in self.muxes if mux.parent is not None}
+        return [(mux, port) for mux in self.muxes if mux.is_reachable() for port in range(8)
+                if mux.mask & (1 << port) and (mux, port) not in cascades]
+
+    def close(self):
+        pass
+
+
+class SimulatedMux:
+    """
+    TCA9548A model with the qwiic_tca9548a interface. Like the driver, enabling or disabling
+    channels reads the control register and writes it back. A multiplexer behind a parent only
+    answers while the parent's port to it is enabled.
+    """
+
+    def __init__(self, backend, address, bus, parent=None, parent_port=None):
+        self.backend = backend
+        self.address = address
+        self.bus = bus
+        self.parent = parent
+        self.parent_port = parent_port
+        self.key = mux_key(address, bus.bus_number, parent.key if parent is not None else None, parent_port)
+        self.mask = 0
+
+    def is_reachable(self):
+        if self.parent is None:
+            return True
+        return bool(self.parent.mask & (1 << self.parent_port)) and self.parent.is_reachable()
+
+    def is_connected(self):
+        self.backend.transaction(self.bus.bus_number)
+        return self.is_reachable()
+
+    def get_enabled_channels(self):
+        self.backend.transaction(self.bus.bus_number)
+        if not self.is_reachable():
+            raise OSError("multiplexer {0} did not acknowledge".format(hex(self.address)))
+        return self.mask
+
+    def enable_channels(self, enable):
+        mask = self.get_enabled_channels()
+        for port in (enable if isinstance(enable, list) else [enable]):
+            mask |= 1 << port
+        self.backend.transaction(self.bus.bus_number)
+        self.mask = mask
+
+    def disable_channels(self, disable):
+        mask = self.get_enabled_channels()
+        for port in (disable if isinstance(disable, list) else [disable]):
+            mask &= ~(1 << port)
+        self.backend.transaction(self.bus.bus_number)
+        self.mask = mask
+
+    def set_channels(self, mask):
+        self.backend.transaction(self.bus.bus_number)
+        if not self.is_reachable():
+            raise OSError("multiplexer {0} did not acknowledge".format(hex(self.address)))
+        self.mask = mask
+
+
+class SimulatedNAU7802:
+    """
+    NAU7802 model with the PyNAU7802 interface, producing conversions in real time.
+    """
+    RATES = {0b000: 10, 0b001: 20, 0b010: 40, 0b011: 80, 0b111: 320}
+
+    def __init__(self, backend, mux, port):
+        self.backend = backend
+        self.mux = mux
+        self.port = port
+        self.bus = None
+        self.rate = 80
+        self.gain = 128
+        self.started = None
+        self.last_read = 0
+        self.zero_offset = 0
+        self.cal_factor = 1.0
+
+    def transaction(self, count=1):
+        """
+        Models I2C transactions to the chip, failing if it is not the only device reachable at 0x2A.
+        """
+        self.backend.transaction(self.mux.bus.bus_number, count)
+        if self.mux.bus.enabled_channels() != [(self.mux, self.port)]:
+            raise OSError("NAU7802 on multiplexer {0} port {1} is not the only device selected".format(
+                hex(self.mux.address), self.port))
+
+    def conversion_count(self):
+        return int((time.monotonic() - self.started) * self.rate)
+
+    def begin(self, wire_port=None, initialize=True):
+        self.bus = wire_port
+        try:
+            # reset, power up, LDO, gain, rate, ADC, PGA and front end calibration registers
+            self.transaction(20)
+        except OSError:
+            return False
+        self.rate = 80
+        self.gain = 128
+        self.started = time.monotonic()
+        self.last_read = 0
+        return True
+
+    def isConnected(self):
+        try:
+            self.transaction()
+        except OSError:
+            return False
+        return True
+
+    def available(self):
+        self.transaction()
+        return self.conversion_count() > self.last_read
+
+    def getReading(self):
+        self.transaction()
+        self.last_read = self.conversion_count()
+        load = self.backend.get_load(self.mux.key, self.port)
+        counts = self.backend.counts_per_kg * self.gain / 128
+        return int(self.backend.get_offset(self.mux.key, self.port) + load * counts +
+                   self.backend.random.gauss(0, self.backend.noise))
+
+    def getAverage(self, average_amount):
+        total = 0
+        samples = 0
+        start = time.time()
+        while samples < average_amount:
+            if self.available():
+                total += self.getReading()
+                samples += 1
+            if time.time() - start > 1.0:
+                return 0
+            time.sleep(0.001)
+        return total / average_amount
+
+    def calculateZeroOffset(self, average_amount=8):
+        self.setZeroOffset(self.getAverage(average_amount))
+
+    def setZeroOffset(self, new_zero_offset):
+        self.zero_offset = new_zero_offset
+
+    def getZeroOffset(self):
+        return self.zero_offset
+
+    def calculateCalibrationFactor(self, weight_on_scale, average_amount=8):
+        self.setCalibrationFactor((self.getAverage(average_amount) - self.zero_offset) / weight_on_scale)
+
+    def setCalibrationFactor(self, new_cal_factor):
+        self.cal_factor = new_cal_factor
+
+    def getCalibrationFactor(self):
+        return self.cal_factor
+
+    def getWeight(self, allow_negative_weights=True, samples_to_take=8):
+        on_scale = self.getAverage(samples_to_take)
+        if not allow_negative_weights and on_scale < self.zero_offset:
+            on_scale = self.zero_offset
+        return (on_scale - self.zero_offset) / self.cal_factor
+
+    def setSampleRate(self, rate):
+        self.transaction(2)
+        self.rate = self.RATES.get(rate, 320)
+        self.started = time.monotonic()
+        self.last_read = 0
+        return True
+
+    def setGain(self, gain_value):
+        self.transaction(2)
+        self.gain = 2 ** min(gain_value, 0b111)
+        return True
+
+    def calibrateAFE(self):
+        self.transaction(3)
+        return True
+
+
+class SimulatedGPIO:
+    """
+    RPi.GPIO model recording every output change with its time.
+    """
+    BCM = 11
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        self.mode = None
+        self.pins = dict()
+        self.events = []
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, channel, direction):
+        self.pins.setdefault(channel, self.LOW)
+
+    def output(self, channel, value):
+        self.pins[channel] = value
+        self.events.append((time.monotonic(), channel, value))
+
+    def input(self, channel):
+        return self.pins.get(channel, self.LOW)
+
+
+class SimulatedThermometer:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_temperature(self):
+        time.sleep(self.backend.thermometer_time)
+        return self.backend.temperature + self.backend.random.gauss(0, 0.05)
+
+
+def mux_key(address, bus_number=1, parent_key=None, parent_port=None):
+    """
+    Identifies a simulated multiplexer, the same address can be reused on another bus or behind
+    another parent port.
+    :return: tuple of (bus number, parent key, parent port, address)
+    """
+    return bus_number, parent_key, parent_port, address
+
+
+BACKENDS = {"hardware": HardwareBackend,
+            "simulated": SimulatedBackend}
+
+backend = None
+
+
+def get_backend():
+    """
+    Returns the process wide backend, chosen by the QWIIC_BACKEND environment variable on first use.
+    :return: HardwareBackend or SimulatedBackend
+    """
+    global backend
+    if backend is None:
+        use_backend(os.environ.get(BACKEND_ENV, "hardware"))
+    return backend
+
+
+def use_backend(new_backend):
+    """
+    Sets the process wide backend. Naming the backend already in use keeps it, so its devices'
+    state is shared by every Experiment in the process.
+    :param new_backend: backend instance or name, "hardware" or "simulated"
+    :return: the backend
+    """
+    global backend
+    if isinstance(new_backend, str):
+        if backend is not None and backend.name == new_backend:
+            return backend
+        if new_backend not in BACKENDS:
+            raise ValueError("unknown backend {0}, expected one of {1}".format(new_backend, ", ".join(BACKENDS)))
+        new_backend = BACKENDS[new_backend]()
+    backend = new_backend
+    return backend
@@ -1,28 +1,39 @@
-from w1thermsensor import W1ThermSensor
-import board
-import busio
 import time
-from datetime import datetime
-i2c = busio.I2C(board.SCL, board.SDA)
-import RPi.GPIO as GPIO
+from datetime import datetime, timedelta
 import json
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import pandas as pd
+import os
+import gdrive_client
+from weight_store import WeightStore, COLUMNS
 import argparse
-from statistics import mean
-import multiprocessing
+import heapq
+import hardware
+from metrics import metrics
+from temperature import TemperatureLog, TemperatureMonitor
 
-# Set GPIO pins to use BCM pin numbers
-GPIO.setmode(GPIO.BCM)
+# RPi.GPIO, or the simulated backend's stand in, set by setup_gpio()
+GPIO = None
 
-# Set digital pin 24 to an input
-GPIO.setup(24, GPIO.IN)
+
+def setup_gpio():
+    """
+    Configures the GPIO pins, called before the first Solenoid is created rather than at import.
+    :return: None
+    """
+    global GPIO
+    if GPIO is not None:
+        return
+    GPIO = hardware.get_backend().get_gpio()
+    # Set GPIO pins to use BCM pin numbers
+    GPIO.setmode(GPIO.BCM)
+
+    # Set digital pin 24 to an input
+    GPIO.setup(24, GPIO.IN)
 
 
 class Solenoid:
     def __init__(self, channel):
         self.channel = channel
+        setup_gpio()
         GPIO.setup(channel, GPIO.OUT)
 
     def open_valve(self):
@@ -38,20 +49,192 @@ class Solenoid:
             open_time = 0
         return open_time
 
-    def water(self, open_time, return_dict):
-        self.open_valve()
-        time.sleep(open_time)
-        self.close_valve()
-        current_time = datetime.now().isoformat()
-        return_dict[self.channel] = current_time
+
+class ValveScheduler:
+    """
+    Opens a set of solenoids together and closes each at its own deadline from a single thread,
+    sleeping until shortly before each deadline and spinning for the last couple of milliseconds.
+    Every valve, and the main valve, is closed even if an exception interrupts watering.
+    """
+
+    def __init__(self, main_valve=None, spin=0.002):
+        """
+        :param main_valve: Solenoid opened before and closed after all the other valves
+        :param spin: seconds before each deadline to stop sleeping and busy wait
+        """
+        self.main_valve = main_valve
+        self.spin = spin
+
+    def run(self, open_times):
+        """
+        :param open_times: dictionary of valve: (Solenoid, seconds to stay open)
+        :return: dictionary of valve: (open timestamp, close timestamp, seconds open) for valves that opened
+        """
+        records = dict()
+        deadlines = []
+        try:
+            if self.main_valve is not None:
+                self.main_valve.open_valve()
+            for order, (valve, (solenoid, open_time)) in enumerate(open_times.items()):
+                if open_time <= 0:
+                    continue
+                solenoid.open_valve()
+                start = time.monotonic()
+                heapq.heappush(deadlines, (start + open_time, order, valve, solenoid, start, datetime.now()))
+            while deadlines:
+                remaining = deadlines[0][0] - time.monotonic()
+                if remaining > self.spin:
+                    time.sleep(remaining - self.spin)
+                    continue
+                deadline, order, valve, solenoid, start, open_timestamp = heapq.heappop(deadlines)
+                while time.monotonic() < deadline:
+                    pass
+                solenoid.close_valve()
+                records[valve] = (open_timestamp.isoformat(), datetime.now().isoformat(), time.monotonic() - start)
+                metrics.observe("valve_close_error_seconds", records[valve][2] - (deadline - start), valve=valve)
+        finally:
+            # closing an already closed valve is harmless, so close every one rather than track state
+            for solenoid, open_time in open_times.values():
+                solenoid.close_valve()
+            if self.main_valve is not None:
+                self.main_valve.close_valve()
+        return records
+
+
+class FlowRates:
+    """
+    Per-valve flow rates in ml/s learned from feedback watering runs, kept in a JSON file.
+    """
+
+    def __init__(self, path, default=0.525, smoothing=0.3, max_change=4.0):
+        """
+        :param path: path of the JSON file
+        :param default: flow rate in ml/s for valves without a measurement
+        :param smoothing: weight of a new measurement in the running estimate
+        :param max_change: measurements more than this factor above or below the current
+            estimate are rejected as implausible
+        """
+        self.path = path
+        self.default = default
+        self.smoothing = smoothing
+        self.max_change = max_change
+        self.rates = dict()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.rates = json.load(f)
+
+    def get_rate(self, valve):
+        return self.rates.get(str(valve), self.default)
+
+    def update(self, valve, delivered, open_time):
+        """
+        Folds a measured delivery into the valve's flow rate estimate.
+        :param valve: valve number
+        :param delivered: ml delivered per pot
+        :param open_time: seconds the valve was open
+        :return: True if the measurement was used
+        """
+        if open_time <= 0 or delivered <= 0:
+            return False
+        measured = delivered / open_time
+        current = self.get_rate(valve)
+        if not current / self.max_change <= measured <= current * self.max_change:
+            return False
+        if str(valve) in self.rates:
+            self.rates[str(valve)] = (1 - self.smoothing) * self.rates[str(valve)] + self.smoothing * measured
+        else:
+            self.rates[str(valve)] = measured
+        return True
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.rates, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class GravimetricController:
+    """
+    Waters each valve until the mean weight gain of the pots on its scales reaches the target,
+    reading the scales continuously while the valves are open. Each valve is also closed after
+    a time limit derived from its expected flow rate in case a scale stops responding.
+    """
+
+    def __init__(self, scale_experiment, main_valve=None, samples=2, settle_time=3, time_factor=2.0):
+        """
+        :param scale_experiment: Qwiic_scales.Experiment used to read the pots
+        :param main_valve: Solenoid opened before and closed after all the other valves
+        :param samples: conversions per scale for each reading while watering
+        :param settle_time: seconds to wait after closing before the final weighing
+        :param time_factor: multiple of the expected open time after which a valve is closed regardless
+        """
+        self.scale_experiment = scale_experiment
+        self.main_valve = main_valve
+        self.samples = samples
+        self.settle_time = settle_time
+        self.time_factor = time_factor
+
+    def get_mean_weight(self, scales, samples):
+        with metrics.timer("stage_seconds", stage="feedback_read"):
+            readings = [i for i in self.scale_experiment.scheduler.read(scales, samples) if i is not None]
+        if not readings:
+            raise IOError("no scale responded")
+        return sum(i.weight for i in readings) / len(readings)
+
+    def run(self, targets):
+        """
+        :param targets: dictionary of valve: (Solenoid, list of Scales, target ml per pot, expected seconds)
+        :return: dictionary of valve: (ml delivered per pot, seconds open, True if closed at the time limit)
+        """
+        baselines = {valve: self.get_mean_weight(targets[valve][1], 8) for valve in targets}
+        open_valves = dict()
+        results = dict()
+        try:
+            if self.main_valve is not None:
+                self.main_valve.open_valve()
+            for valve, (solenoid, scales, target, expected_time) in targets.items():
+                solenoid.open_valve()
+                open_valves[valve] = time.monotonic()
+            while open_valves:
+                for valve in list(open_valves.keys()):
+                    solenoid, scales, target, expected_time = targets[valve]
+                    elapsed = time.monotonic() - open_valves[valve]
+                    try:
+                        delivered = (self.get_mean_weight(scales, self.samples) - baselines[valve]) * 1000
+                    except IOError as e:
+                        print("valve {0}: {1}, closing on time limit".format(valve, e))
+                        delivered = None
+                    timed_out = elapsed > expected_time * self.time_factor
+                    if (delivered is not None and delivered >= target) or timed_out:
+                        solenoid.close_valve()
+                        del open_valves[valve]
+                        results[valve] = (elapsed, timed_out)
+                        if timed_out:
+                            print("valve {0}: closed at time limit after {1:.1f} s".format(valve, elapsed))
+        finally:
+            for solenoid, scales, target, expected_time in targets.values():
+                solenoid.close_valve()
+            if self.main_valve is not None:
+                self.main_valve.close_valve()
+        time.sleep(self.settle_time)
+        delivered = dict()
+        for valve, (open_time, timed_out) in results.items():
+            try:
+                delivered[valve] = ((self.get_mean_weight(targets[valve][1], 8) - baselines[valve]) * 1000,
+                                    open_time, timed_out)
+            except IOError:
+                delivered[valve] = (None, open_time, timed_out)
+        return delivered
+
 
 class ds18b20:
     def __init__(self):
-        self.ds18b20 = W1ThermSensor()
+        self.ds18b20 = hardware.get_backend().make_thermometer()
         self.log = dict()
 
     def get_temperature(self):
-        return self.ds18b20.get_temperature()
+        with metrics.timer("stage_seconds", stage="temperature"):
+            return self.ds18b20.get_temperature()
 
     def log_temperature(self):
         self.log.setdefault(datetime.now().isoformat(), self.get_temperature())
@@ -64,46 +247,104 @@ class Experiment:
     def __init__(self, treatments):
         with open(treatments, "r") as f:
             self.treatment_dict = json.load(f)
+        if "backend" in self.treatment_dict:
+            hardware.use_backend(self.treatment_dict["backend"])
+        metrics.configure(self.treatment_dict.get("metrics"), self.treatment_dict["output_dir"])
         self.solenoid_dict = {}
         for valve in self.treatment_dict["valves"].keys():
 
             self.solenoid_dict.setdefault("s" + str(self.treatment_dict["valves"][valve]["valve_number"]),
                                           Solenoid(self.treatment_dict["valves"][valve]["valve_pin"]))
+        self.mirrors = dict()
+        self.treatment_file = treatments
+        self.flow_rates = FlowRates(os.path.join(self.treatment_dict["output_dir"], "flow_rates.json"))
+        # readings are also cached for Qwiic_scales.py, which uses the latest for calibration
+        self.temperature_monitor = TemperatureMonitor(
+            TemperatureLog(os.path.join(self.treatment_dict["output_dir"],
+                                        self.treatment_dict.get("temperature_cache", "temperature_cache.bin"))))
+
+    def start_temperature_read(self):
+        """
+        Starts reading the DS18B20 in the background so the conversion overlaps watering.
+        :return: Future of the temperature
+        """
+        return self.temperature_monitor.read_async()
+
+    def open_spreadsheet(self, spreadsheet):
+        return gdrive_client.open_spreadsheet(self.treatment_dict["gdrive_credential"], spreadsheet)
+
+    def read_sheet(self, spreadsheet, sheet_name):
+        """
+        Reads a worksheet through its local mirror, only downloading rows added since the last run.
+        :param spreadsheet: name of Google spreadsheet
+        :param sheet_name: name of worksheet
+        :return: DataFrame of the worksheet
+        """
+        from sheet_mirror import SheetMirror
+
+        if sheet_name not in self.mirrors:
+            cache_dir = self.treatment_dict.get("sheet_cache_dir",
+                                                os.path.join(self.treatment_dict["output_dir"], "sheet_cache"))
+            os.makedirs(cache_dir, exist_ok=True)
+            path = os.path.join(cache_dir, "{0}_{1}.csv".format(spreadsheet, sheet_name))
+            self.mirrors[sheet_name] = SheetMirror(self.open_spreadsheet(spreadsheet), sheet_name, path)
+        with metrics.timer("stage_seconds", stage="sheet_sync", sheet=sheet_name):
+            new_rows = self.mirrors[sheet_name].sync()
+        print("{0}: fetched {1} new rows from {2}".format(datetime.now(), new_rows, sheet_name))
+        return self.mirrors[sheet_name].to_dataframe()
 
-    def read_gs_data(self, spreadsheet, sheet_name):
-        scope = ['https://spreadsheets.google.com/feeds',
-                'https://www.googleapis.com/auth/drive']
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            self.treatment_dict["gdrive_credential"], scope)
-        gc = gspread.authorize(credentials)
-        sheet = gc.open(spreadsheet).worksheet(sheet_name)
-        gs_df = pd.DataFrame(sheet.get_all_records())
-        return gs_df
+    def read_local_weights(self, since=None):
+        """
+        Reads weights from the local weight store written by Qwiic_scales.py instead of the sheet.
+        :param since: only return weights after this timestamp
+        :return: DataFrame of weights
+        """
+        import pandas as pd
+
+        store = WeightStore(os.path.join(self.treatment_dict["output_dir"], self.treatment_dict["weight_store"]))
+        try:
+            rows = store.since(since.isoformat() if since is not None else None)
+        finally:
+            store.close()
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+    def read_timeseries_weights(self, since=None):
+        """
+        Reads weights from the binary log written by Qwiic_scales.py, only loading the days after since.
+        :param since: only return weights after this timestamp
+        :return: DataFrame of weights
+        """
+        from timeseries import TimeSeriesStore
+
+        store = TimeSeriesStore(os.path.join(self.treatment_dict["output_dir"], self.treatment_dict["timeseries_dir"]))
+        if since is not None:
+            # query() includes the start, the log has microsecond timestamps
+            since = since + timedelta(microseconds=1)
+        return store.to_dataframe(start=since)
 
     def get_water_lost(self):
-        water_log = self.read_gs_data(self.treatment_dict["spreadsheet"], "irrigation_log")
-        water_log["timestamp"] = pd.to_datetime(water_log["timestamp"])
-        weight_df = self.read_gs_data(self.treatment_dict["spreadsheet"],
-                                      self.treatment_dict["sheet_name"])
-        weight_df["datetime"] = [pd.to_datetime(i) for i in weight_df["Timestamp"]]
+        """
+        :return: Series of mean water lost in ml per pot since the last watering, indexed by valve
+        """
+        from analysis import parse_timestamps, water_lost_by_valve
+
+        water_log = self.read_sheet(self.treatment_dict["spreadsheet"], "irrigation_log")
+        last_watering = None
         if len(water_log.index) > 0:
-            last_watering = water_log.loc[max(water_log.index), "timestamp"]
-            recent_weight = weight_df.loc[weight_df["datetime"] > last_watering]
-        else:
-            recent_weight = weight_df
-        water_lost = dict()
-        for group in recent_weight.groupby(["Multiplexer", "Scale"]):
-            prev_weight = (group[1].loc[min(group[1].index), "Weight"]) * 1000
-            cur_weight = (group[1].loc[max(group[1].index), "Weight"]) * 1000
-            diff = prev_weight - cur_weight
-            water_lost.setdefault(group[0][0], []).append(diff)
-        return water_lost
+            last_watering = parse_timestamps(water_log["timestamp"]).iloc[-1]
+        if self.treatment_dict.get("water_loss_source") == "local":
+            return water_lost_by_valve(self.read_local_weights(since=last_watering))
+        if self.treatment_dict.get("water_loss_source") == "timeseries":
+            return water_lost_by_valve(self.read_timeseries_weights(since=last_watering))
+        weight_df = self.read_sheet(self.treatment_dict["spreadsheet"],
+                                    self.treatment_dict["sheet_name"])
+        return water_lost_by_valve(weight_df, since=last_watering)
 
     def get_water_amount(self):
-        water_lost = self.get_water_lost()
+        with metrics.timer("stage_seconds", stage="water_loss"):
+            water_lost = self.get_water_lost()
         water_amount = dict()
-        for valve in water_lost.keys():
-            avg_loss = mean(water_lost[valve])
+        for valve, avg_loss in water_lost.items():
             amount = float(self.treatment_dict["valves"][str(valve)]["amount"])*avg_loss
             print(amount)
             water_amount.setdefault(valve, amount)
@@ -113,25 +354,79 @@ class Experiment:
         sm = Solenoid(21)
         solenoid_dict = dict()
         water_amount = self.get_water_amount()
-        sm.open_valve()
         for valve in water_amount:
             solenoid_dict.setdefault(valve, Solenoid(self.treatment_dict["valves"][str(valve)]["valve_pin"]))
 
-        manager = multiprocessing.Manager()
-        return_dict = manager.dict()
-        jobs = []
-        for valve in solenoid_dict.keys():
-            p = multiprocessing.Process(target=solenoid_dict[valve].water,
-                                        args=(solenoid_dict[valve].water_time(
-                                                    amount=water_amount[valve]), return_dict))
-            jobs.append(p)
-            p.start()
-        for process in jobs:
-            process.join()
-        sm.close_valve()
+        open_times = {valve: (solenoid_dict[valve], solenoid_dict[valve].water_time(
+                          amount=water_amount[valve], rate=self.flow_rates.get_rate(valve)))
+                      for valve in solenoid_dict.keys()}
+        records = ValveScheduler(main_valve=sm).run(open_times)
+        for valve in records:
+            print("valve {0} opened {1} closed {2} ({3:.3f} s of {4:.3f} s)".format(
+                valve, records[valve][0], records[valve][1], records[valve][2], open_times[valve][1]))
         self.write_water_data(spreadsheet, water_amount)
 
+    def water_pots_feedback(self, spreadsheet):
+        """
+        Waters each valve until its scales show the target weight gain and learns each valve's
+        flow rate from the result.
+        :param spreadsheet: name of Google spreadsheet
+        :return: None
+        """
+        from Qwiic_scales import Experiment as ScaleExperiment
+
+        scale_experiment = ScaleExperiment(self.treatment_file)
+        scale_dict = dict()
+        for mux, scale, scale_obj in scale_experiment.get_calibrated_scales("all"):
+            scale_dict.setdefault(mux, []).append(scale_obj)
+        water_amount = self.get_water_amount()
+        targets = dict()
+        for valve in water_amount:
+            solenoid = Solenoid(self.treatment_dict["valves"][str(valve)]["valve_pin"])
+            expected_time = solenoid.water_time(amount=water_amount[valve], rate=self.flow_rates.get_rate(valve))
+            if expected_time == 0 or str(valve) not in scale_dict:
+                continue
+            targets[valve] = (solenoid, scale_dict[str(valve)], water_amount[valve], expected_time)
+        controller = GravimetricController(scale_experiment, main_valve=Solenoid(21),
+                                           settle_time=float(self.treatment_dict.get("settle_time", 3)))
+        try:
+            results = controller.run(targets)
+        finally:
+            scale_experiment.session.close()
+        for valve, (delivered, open_time, timed_out) in results.items():
+            if delivered is None:
+                print("valve {0}: open {1:.1f} s, delivery not measured".format(valve, open_time))
+                continue
+            print("valve {0}: target {1:.1f} ml, delivered {2:.1f} ml in {3:.1f} s".format(
+                valve, targets[valve][2], delivered, open_time))
+            # a run stopped by the time limit did not reach the target, eg. a scale that stopped
+            # responding, so its delivery says nothing reliable about the flow rate
+            if timed_out:
+                print("valve {0}: closed at the time limit, flow rate not updated".format(valve))
+            elif not self.flow_rates.update(valve, delivered, open_time):
+                print("valve {0}: measured {1:.3f} ml/s is implausible against {2:.3f} ml/s, flow rate not "
+                      "updated".format(valve, delivered / open_time if open_time > 0 else 0.0,
+                                       self.flow_rates.get_rate(valve)))
+        self.flow_rates.save()
+        self.write_water_data(spreadsheet, water_amount)
+
+    def open_valves(self, valve_times):
+        """
+        Opens valves for fixed times without reading or logging any data, eg. to prime the lines.
+        :param valve_times: valves and seconds to open them for eg. 1:10,2:5
+        :return: None
+        """
+        open_times = dict()
+        for pair in valve_times.strip().split(","):
+            valve, open_time = pair.strip().split(":")
+            open_times[valve] = (Solenoid(self.treatment_dict["valves"][valve]["valve_pin"]), float(open_time))
+        records = ValveScheduler(main_valve=Solenoid(21)).run(open_times)
+        for valve in records:
+            print("valve {0} opened {1} closed {2} ({3:.3f} s)".format(valve, *records[valve]))
+
     def get_water_info(self, water_amount):
+        import pandas as pd
+
         water_amount = water_amount
         timestamp = [datetime.now().isoformat() for i in range(len(water_amount.keys()))]
         valve = [i for i in water_amount.keys()]
@@ -143,28 +438,27 @@ class Experiment:
 
     def write_water_data(self, spreadsheet, water_amount):
         water_df = self.get_water_info(water_amount=water_amount)
-        scope = ['https://spreadsheets.google.com/feeds',
-                 'https://www.googleapis.com/auth/drive']
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            self.treatment_dict["gdrive_credential"], scope)
-        gc = gspread.authorize(credentials)
-        sheet = gc.open(spreadsheet)
+        sheet = self.open_spreadsheet(spreadsheet)
         values = water_df.values.tolist()
+        metrics.count("api_calls_total", call="values_append")
         sheet.values_append("irrigation_log",
                             {'valueInputOption': "USER_ENTERED"},
                             {'values': values})
 
-    def write_temp_data(self, spreadsheet, sheet_name):
-        temp_guage = ds18b20()
-        temp = temp_guage.get_temperature()
+    def write_temp_data(self, spreadsheet, sheet_name, temperature=None):
+        """
+        :param temperature: Future from start_temperature_read() or a temperature, read now if None
+        """
+        if temperature is None:
+            temp = self.temperature_monitor.read()
+        elif hasattr(temperature, "result"):
+            temp = temperature.result()
+        else:
+            temp = temperature
         current_time = datetime.now().isoformat()
-        scope = ['https://spreadsheets.google.com/feeds',
-                 'https://www.googleapis.com/auth/drive']
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-                self.treatment_dict["gdrive_credential"], scope)
-        gc = gspread.authorize(credentials)
-        sheet = gc.open(spreadsheet)
+        sheet = self.open_spreadsheet(spreadsheet)
         values = [[current_time, temp]]
+        metrics.count("api_calls_total", call="values_append")
         sheet.values_append(sheet_name,
                             {'valueInputOption': "USER_ENTERED"},
                             {'values': values})
@@ -174,6 +468,10 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--treatment", help="path to treatments json file")
     parser.add_argument("-w", "--water", help="Water the pots if True", default="false")
+    parser.add_argument("-f", "--feedback", help="water until the scales show the target weight gain",
+                        action="store_true")
+    parser.add_argument("-o", "--open", help="open valves for a number of seconds and exit (valve:seconds) \n"
+                                             "eg. 1:10,2:5", default=None)
     args= parser.parse_args()
     treatment_file = args.treatment
     water = args.water
@@ -182,11 +480,23 @@ def main():
     else:
         water = False
     my_experiment = Experiment(treatment_file)
-    my_experiment.write_temp_data(spreadsheet=my_experiment.treatment_dict["spreadsheet"],
-                                  sheet_name="temperature_log")
-    if water is True:
-        print("watering at {0}".format(datetime.now().isoformat()))
-        my_experiment.water_pots(spreadsheet=my_experiment.treatment_dict["spreadsheet"])
+    if args.open is not None:
+        my_experiment.open_valves(args.open)
+        metrics.write_json()
+        return
+    temperature = my_experiment.start_temperature_read()
+    try:
+        if water is True:
+            print("watering at {0}".format(datetime.now().isoformat()))
+            if args.feedback:
+                my_experiment.water_pots_feedback(spreadsheet=my_experiment.treatment_dict["spreadsheet"])
+            else:
+                my_experiment.water_pots(spreadsheet=my_experiment.treatment_dict["spreadsheet"])
+    finally:
+        my_experiment.write_temp_data(spreadsheet=my_experiment.treatment_dict["spreadsheet"],
+                                      sheet_name="temperature_log", temperature=temperature)
+        my_experiment.temperature_monitor.stop()
+    metrics.write_json()
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,224 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Set to 1 to collect metrics without a "metrics" entry in the treatment file
+METRICS_ENV = "QWIIC_METRICS"
+
+
+class NullTimer:
+    """
+    Timer returned while metrics are disabled, entering and leaving it does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Timing:
+    """
+    Totals of a timed stage plus its most recent durations for the quantiles.
+    """
+
+    def __init__(self, window):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.recent = deque(maxlen=window)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+        self.recent.append(seconds)
+
+    def quantile(self, q):
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max, "last": self.last, "p50": self.quantile(0.5), "p95": self.quantile(0.95)}
+
+
+class Metrics:
+    """
+    Process wide counters and stage timings. Disabled by default, in which case count() and
+    observe() return straight away and timer() hands back a shared no-op timer, so the
+    instrumented hot paths only pay for a method call.
+
+    Names follow Prometheus conventions, eg. counters end in _total and timings in _seconds, and
+    keyword arguments become labels: metrics.count("i2c_transactions_total", op="read").
+    """
+
+    def __init__(self, window=100):
+        self.enabled = False
+        self.window = window
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.timings = dict()
+        self.json_file = None
+        self.server = None
+
+    def count(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.timings:
+                self.timings[key] = Timing(self.window)
+            self.timings[key].add(seconds)
+
+    def timer(self, name, **labels):
+        """
+        Context manager recording the duration of its block, eg.
+        with metrics.timer("stage_seconds", stage="sample"): ...
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.timings = dict()
+
+    def snapshot(self):
+        """
+        :return: dictionary of counters and timings, each a list of {"name", "labels", ...} entries
+        """
+        with self.lock:
+            return {"time": time.time(),
+                    "counters": [{"name": name, "labels": dict(labels), "value": value}
+                                 for (name, labels), value in sorted(self.counters.items())],
+                    "timings": [dict(name=name, labels=dict(labels), **timing.to_dict())
+                                for (name, labels), timing in sorted(self.timings.items())]}
+
+    def to_prometheus(self):
+        """
+        :return: metrics in the Prometheus text exposition format, timings as summaries over the recent window
+        """
+        lines = []
+        snapshot = self.snapshot()
+        for name in sorted({i["name"] for i in snapshot["counters"]}):
+            lines.append("# TYPE {0} counter".format(name))
+            for entry in snapshot["counters"]:
+                if entry["name"] == name:
+                    lines.append("{0}{1} {2}".format(name, format_labels(entry["labels"]), entry["value"]))
+        for name in sorted({i["name"] for i in snapshot["timings"]}):
+            lines.append("# TYPE {0} summary".format(name))
+            for entry in snapshot["timings"]:
+                if entry["name"] != name:
+                    continue
+                for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+                    labels = dict(entry["labels"], quantile=quantile)
+                    lines.append("{0}{1} {2}".format(name, format_labels(labels), entry[key]))
+                lines.append("{0}_sum{1} {2}".format(name, format_labels(entry["labels"]), entry["total"]))
+                lines.append("{0}_count{1} {2}".format(name, format_labels(entry["labels"]), entry["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path=None):
+        """
+        Replaces the stats file with the current snapshot.
+        :param path: file to write, defaults to the configured json_file
+        :return: None
+        """
+        path = path or self.json_file
+        if not self.enabled or path is None:
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serves the metrics in Prometheus text format at http://host:port/metrics from a daemon thread.
+        :return: None
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print("Serving metrics at http://{0}:{1}/metrics".format(host, port))
+
+    def configure(self, config, output_dir="."):
+        """
+        Enables metrics from the treatment file's "metrics" entry, eg.
+        "metrics": {"json_file": "metrics.json", "port": 9105, "window": 100}
+        :param config: dictionary of metrics settings, or None to only honour the QWIIC_METRICS variable
+        :param output_dir: directory a relative json_file is written to
+        :return: None
+        """
+        if config is None:
+            if os.environ.get(METRICS_ENV, "0") not in ("", "0"):
+                self.enabled = True
+            return
+        self.enabled = bool(config.get("enabled", True))
+        if not self.enabled:
+            return
+        self.window = int(config.get("window", self.window))
+        if "json_file" in config:
+            self.json_file = os.path.join(output_dir, config["json_file"])
+        if "port" in config and self.server is None:
+            self.serve(int(config["port"]), config.get("host", "127.0.0.1"))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(key, str(value).replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + "}"
+
+
+metrics = Metrics()
@@ -0,0 +1,139 @@
+from array import array
+
+from timeseries import DTYPE, to_ns, from_ns
+
+
+class ReadingBuffer:
+    """
+    Readings of many cycles held in preallocated typed arrays, one slot per reading, so a cycle
+    adds numbers to the arrays instead of building lists and DataFrames. A cycle's timestamp is
+    stored once as int64 ns and each scale as an index into the channels it has seen. Rows,
+    DataFrames and timeseries records are only built by the to_* methods when the buffer is flushed.
+    When full, the arrays double in size.
+    """
+
+    def __init__(self, capacity=1024):
+        """
+        :param capacity: readings held before the arrays grow
+        """
+        self.capacity = capacity
+        self.size = 0
+        self.timestamps = array("q", bytes(8 * capacity))
+        self.channels = array("H", bytes(2 * capacity))
+        self.weights = array("d", bytes(8 * capacity))
+        self.raws = array("d", bytes(8 * capacity))
+        self.stds = array("d", bytes(8 * capacity))
+        self.samples = array("I", bytes(4 * capacity))
+        # (multiplexer, scale) of each channel index
+        self.channel_keys = []
+        self.channel_index = dict()
+
+    def __len__(self):
+        return self.size
+
+    def get_channel(self, mux, scale):
+        """
+        :return: index of the (multiplexer, scale) channel, added the first time it is seen
+        """
+        key = (mux, scale)
+        if key not in self.channel_index:
+            self.channel_index[key] = len(self.channel_keys)
+            self.channel_keys.append(key)
+        return self.channel_index[key]
+
+    def grow(self):
+        for values in (self.timestamps, self.channels, self.weights, self.raws, self.stds, self.samples):
+            values.extend(values)
+        self.capacity *= 2
+
+    def add_cycle(self, timestamp, channels, readings):
+        """
+        Adds one cycle's readings.
+        :param timestamp: datetime of the cycle
+        :param channels: list of (multiplexer, scale) in the order of readings
+        :param readings: list of Qwiic_scales.Reading, None for scales that were not read
+        :return: number of readings added
+        """
+        ns = to_ns(timestamp)
+        added = 0
+        for (mux, scale), reading in zip(channels, readings):
+            if reading is None:
+                continue
+            if self.size == self.capacity:
+                self.grow()
+            i = self.size
+            self.timestamps[i] = ns
+            self.channels[i] = self.get_channel(mux, scale)
+            self.weights[i] = reading.weight
+            self.raws[i] = reading.raw
+            self.stds[i] = reading.std
+            self.samples[i] = reading.samples
+            self.size += 1
+            added += 1
+        return added
+
+    def clear(self):
+        """
+        Empties the buffer, keeping its arrays for the next readings.
+        :return: None
+        """
+        self.size = 0
+
+    def get_timestamps(self):
+        """
+        :return: list of ISO format timestamps, formatted once per cycle
+        """
+        formatted = dict()
+        result = []
+        for ns in self.timestamps[:self.size]:
+            if ns not in formatted:
+                formatted[ns] = from_ns(ns).isoformat()
+            result.append(formatted[ns])
+        return result
+
+    def to_rows(self, columns=7):
+        """
+        :param columns: number of leading [timestamp, multiplexer, scale, weight, raw, std, samples] columns
+        :return: list of rows as written to the weight sheet by Qwiic_scales
+        """
+        rows = []
+        for timestamp, channel, weight, raw, std, samples in zip(self.get_timestamps(), self.channels, self.weights,
+                                                                  self.raws, self.stds, self.samples):
+            mux, scale = self.channel_keys[channel]
+            rows.append([timestamp, mux, scale, weight, raw, std, samples][:columns])
+        return rows
+
+    def to_dataframe(self, columns):
+        """
+        :param columns: names of the timestamp, multiplexer, scale, weight, raw, std and samples columns
+        :return: DataFrame with the numeric columns copied straight from the arrays
+        """
+        import numpy as np
+        import pandas as pd
+
+        channels = np.frombuffer(self.channels, dtype=np.uint16, count=self.size)
+        keys = self.channel_keys
+        data = {columns[0]: self.get_timestamps(),
+                columns[1]: [keys[i][0] for i in channels],
+                columns[2]: [keys[i][1] for i in channels],
+                columns[3]: np.frombuffer(self.weights, count=self.size).copy(),
+                columns[4]: np.frombuffer(self.raws, count=self.size).copy(),
+                columns[5]: np.frombuffer(self.stds, count=self.size).copy(),
+                columns[6]: np.frombuffer(self.samples, dtype=np.uint32, count=self.size).astype(int)}
+        return pd.DataFrame(data, columns=columns)
+
+    def to_records(self):
+        """
+        :return: numpy structured array of timeseries.DTYPE records, the multiplexer (valve) and
+            scale of every channel must be numbers
+        """
+        import numpy as np
+
+        records = np.zeros(self.size, dtype=DTYPE)
+        channels = np.frombuffer(self.channels, dtype=np.uint16, count=self.size)
+        records["timestamp"] = np.frombuffer(self.timestamps, dtype=np.int64, count=self.size)
+        records["mux"] = np.array([int(mux) for mux, scale in self.channel_keys], dtype=np.uint16)[channels]
+        records["port"] = np.array([int(scale) for mux, scale in self.channel_keys], dtype=np.uint8)[channels]
+        records["weight"] = np.frombuffer(self.weights, count=self.size)
+        records["raw"] = np.frombuffer(self.raws, count=self.size)
+        return records
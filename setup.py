@@ -11,6 +11,7 @@ setup(name='pi_Qwiic_scales',
                 'PyNAU7802',
                 'smbus2',
                 'sparkfun-qwiic',
+                'sparkfun-qwiic-tca9548a',
                 'PyDrive',
                 'gspread',
                 'gspread_dataframe',
@@ -0,0 +1,73 @@
+import csv
+import os
+from metrics import metrics
+
+
+class SheetMirror:
+    """
+    Local CSV copy of a worksheet. The number of mirrored rows is the high-water mark, so each
+    sync only requests the rows appended to the sheet since the last one.
+    """
+
+    def __init__(self, spreadsheet, sheet_name, path):
+        """
+        :param spreadsheet: gspread Spreadsheet holding the worksheet
+        :param sheet_name: name of worksheet to mirror
+        :param path: path of the local CSV mirror
+        """
+        self.spreadsheet = spreadsheet
+        self.sheet_name = sheet_name
+        self.path = path
+        self.header = None
+        self.row_count = 0
+        if os.path.exists(path):
+            with open(path, "r", newline="") as f:
+                reader = csv.reader(f)
+                self.header = next(reader, None)
+                self.row_count = sum(1 for i in reader)
+
+    def sync(self):
+        """
+        Appends the rows added to the worksheet since the last sync to the local mirror.
+        :return: number of new rows
+        """
+        # row 1 of the sheet is the header, data row n is sheet row n + 1
+        start = self.row_count + 2 if self.header is not None else 1
+        metrics.count("api_calls_total", call="values_get")
+        response = self.spreadsheet.values_get("'{0}'!A{1}:ZZ".format(self.sheet_name, start))
+        values = response.get("values", [])
+        if self.header is None:
+            if not values:
+                return 0
+            self.header = values[0]
+            values = values[1:]
+            with open(self.path, "w", newline="") as f:
+                csv.writer(f).writerow(self.header)
+        # the API leaves out trailing empty cells
+        width = len(self.header)
+        rows = [row[:width] + [""] * (width - len(row)) for row in values]
+        if rows:
+            with open(self.path, "a", newline="") as f:
+                csv.writer(f).writerows(rows)
+            self.row_count += len(rows)
+        return len(rows)
+
+    def reset(self):
+        """
+        Discards the local mirror so the next sync downloads the whole worksheet.
+        :return: None
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.header = None
+        self.row_count = 0
+
+    def to_dataframe(self):
+        """
+        :return: DataFrame of the mirrored rows with the sheet header as columns
+        """
+        import pandas as pd
+
+        if self.header is None:
+            return pd.DataFrame()
+        return pd.read_csv(self.path)
@@ -1,59 +1,233 @@
 import argparse
-from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
-from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
+import hashlib
+import json
 import os
+import re
+import gdrive_client
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+# Resumable upload chunks must be a multiple of 256 KiB
+CHUNK_UNIT = 256 * 1024
+DAY_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}")
 
 
 def connect_to_drive(credential):
     """
-    Creates new Google Drive connection
+    Returns the process wide Google Drive connection, created on first use
     :param credential: path to client_secret.json file
-    :return: New Google Drive instance
+    :return: Google Drive instance
+    """
+    return gdrive_client.get_drive(credential)
+
+
+class SyncState:
+    """
+    What has been uploaded, kept in a JSON file between runs: Drive folder ids by name, and for each
+    uploaded file its Drive id with the size, modification time and MD5 of the uploaded content,
+    and how far each log has been split into daily segments.
+    Files whose size and modification time are unchanged are skipped without being read, and files
+    that were touched but hash the same are skipped without being uploaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {"folders": {}, "files": {}, "segments": {}}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.state.update(json.load(f))
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get_folder_id(self, folder_name):
+        return self.state["folders"].get(folder_name)
+
+    def set_folder_id(self, folder_name, folder_id):
+        self.state["folders"][folder_name] = folder_id
+
+    def get_file(self, folder_id, file_name):
+        return self.state["files"].get("{0}/{1}".format(folder_id, file_name))
+
+    def set_file(self, folder_id, file_name, record):
+        self.state["files"]["{0}/{1}".format(folder_id, file_name)] = record
+
+    def forget_folder(self, folder_name):
+        folder_id = self.state["folders"].pop(folder_name, None)
+        for key in [i for i in self.state["files"] if i.startswith("{0}/".format(folder_id))]:
+            del self.state["files"][key]
+
+
+def get_md5(path, block_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_folder_id(drive, folder_name, state):
+    """
+    :return: id of the Drive folder, listing the folders only if the id is not cached
     """
-    gauth = GoogleAuth()
-    scope = ['https://www.googleapis.com/auth/drive']
-    gauth.credentials = ServiceAccountCredentials.from_json_keyfile_name(credential, scope)
-    drive = GoogleDrive(gauth)
-    return drive
+    folder_id = state.get_folder_id(folder_name)
+    if folder_id is None:
+        folders = drive.ListFile(
+            {'q': "title='{0}' and mimeType='{1}' and trashed=false".format(folder_name, FOLDER_MIME_TYPE)}).GetList()
+        folders = [i for i in folders if i['title'] == folder_name]
+        if not folders:
+            raise IOError("Google Drive folder {0} not found".format(folder_name))
+        folder_id = folders[0]['id']
+        state.set_folder_id(folder_name, folder_id)
+    return folder_id
 
 
-def upload_file(file, folder, credential):
+def find_file(drive, folder_id, file_name):
     """
-    Uploads a file to a specified Google Drive folder.
+    :return: the Drive file's metadata or None if the folder does not contain it
+    """
+    file_list = drive.ListFile(
+        {'q': "'{0}' in parents and title='{1}' and trashed=false".format(folder_id, file_name.replace("'", "\\'"))}
+    ).GetList()
+    return file_list[0] if file_list else None
+
+
+def send_file(drive, file, folder_id, file_id=None, chunk_size=5 * 1024 * 1024):
+    """
+    Uploads a file's content with a resumable upload, in chunk_size pieces so a dropped connection
+    only repeats the current chunk.
+    :param file_id: id of the Drive file to replace, None to create a new file
+    :return: the Drive file's metadata
+    """
+    from googleapiclient.http import MediaFileUpload
+
+    if drive.auth.service is None:
+        drive.auth.Authorize()
+    chunk_size = max(CHUNK_UNIT, chunk_size // CHUNK_UNIT * CHUNK_UNIT)
+    media = MediaFileUpload(file, mimetype="application/octet-stream", chunksize=chunk_size, resumable=True)
+    if file_id is None:
+        request = drive.auth.service.files().insert(
+            body={'title': os.path.basename(file), 'parents': [{'id': folder_id}]}, media_body=media)
+    else:
+        request = drive.auth.service.files().update(fileId=file_id, media_body=media)
+    response = None
+    while response is None:
+        status, response = request.next_chunk(num_retries=5)
+        if status is not None and status.total_size > chunk_size:
+            print("{0}: {1} {2:.0%}".format(datetime.now(), os.path.basename(file), status.progress()))
+    return response
+
+
+def upload_file(file, folder, credential, state=None, chunk_size=5 * 1024 * 1024):
+    """
+    Uploads a file to a specified Google Drive folder, skipping it if its content is unchanged since
+    the last upload.
     :param file: Source file to upload to drive
     :param folder: Name of Google Drive destination folder
     :param credential: Path to client_secret.json file
-    :return: None
+    :param state: SyncState, None to keep the state next to the file
+    :param chunk_size: bytes per resumable upload request
+    :return: True if the file was uploaded
     """
+    if state is None:
+        state = SyncState(os.path.join(os.path.dirname(os.path.abspath(file)), ".sync_state.json"))
     drive = connect_to_drive(credential=credential)
-    folder_name = folder  # Please set the folder name.
     file_name = os.path.basename(file)
+    folder_id = get_folder_id(drive, folder, state)
+    record = state.get_file(folder_id, file_name)
+    size, mtime = os.path.getsize(file), os.path.getmtime(file)
+    if record is not None and record["size"] == size and record["mtime"] == mtime:
+        return False
+    md5 = get_md5(file)
+    if record is None:
+        drive_file = find_file(drive, folder_id, file_name)
+        if drive_file is not None:
+            record = {"id": drive_file['id'], "md5": drive_file.get('md5Checksum')}
+    if record is not None and record.get("md5") == md5:
+        state.set_file(folder_id, file_name, dict(record, size=size, mtime=mtime))
+        state.save()
+        return False
+    try:
+        if record is None:
+            print("{0}: Creating new file {1}".format(datetime.now(), file_name))
+        else:
+            print("{0}: Updating existing file {1}".format(datetime.now(), file_name))
+        response = send_file(drive, file, folder_id, record and record["id"], chunk_size)
+    except Exception as e:
+        if getattr(getattr(e, "resp", None), "status", None) != 404:
+            raise
+        # the cached file, or for a new file the cached folder, was deleted from Drive
+        if record is None:
+            state.forget_folder(folder)
+            folder_id = get_folder_id(drive, folder, state)
+        print("{0}: {1} no longer on Drive, creating it again".format(datetime.now(), file_name))
+        response = send_file(drive, file, folder_id, None, chunk_size)
+    state.set_file(folder_id, file_name, {"id": response['id'], "md5": response.get('md5Checksum', md5),
+                                          "size": size, "mtime": mtime})
+    state.save()
+    return True
 
-    folders = drive.ListFile(
-        {
-            'q': "title='" + folder_name + "' ""and mimeType='application/vnd.google-apps.folder' and trashed=false"}).GetList()
-    for folder in folders:
-        if folder['title'] == folder_name:
-            file_list = drive.ListFile({'q': "'"+folder['id']+"' in parents and trashed=false"}).GetList()
-            file_exists = False
-            for drive_file in file_list:
-                if drive_file['title'] == file_name:
-                    file_exists = True
-                    print(drive_file['id'])
-                    print("{0}: Updating existing file {1}".format(datetime.now(), file_name))
-                    drive_file['title'] = file_name
-                    file1 = drive.CreateFile({'id': drive_file['id'],
-                                              'parents': [{'id': folder['id']}]})
-                    file1.SetContentFile(file)
-                    file1.Upload()
-            if file_exists is False:
-                print("{0}: Creating new file {1}".format(datetime.now(), file_name))
-                file2 = drive.CreateFile({'parents': [{'id': folder['id']}]})
-                file2['title'] = file_name
-                file2.SetContentFile(file)
-                file2.Upload()
+
+def split_daily(source, segment_dir, state):
+    """
+    Appends the lines added to a log since the last call to one segment file per day, named
+    <name>_<YYYY-MM-DD><ext> after the date each line starts with, so past days' segments stop
+    changing. Lines without a date go to the segment of the line before. The header line is copied
+    to the top of every segment.
+    :param source: log file with an ISO timestamp in its first column
+    :param segment_dir: directory of the segment files
+    :param state: SyncState recording how far the log has been split
+    :return: list of segment files written to
+    """
+    os.makedirs(segment_dir, exist_ok=True)
+    stem, ext = os.path.splitext(os.path.basename(source))
+    split = state.state["segments"].get(os.path.abspath(source), {"offset": 0, "day": None})
+    offset = split["offset"]
+    if os.path.getsize(source) < offset:
+        # the log was replaced, start again
+        offset = 0
+    with open(source, "rb") as f:
+        header = f.readline()
+        if DAY_PATTERN.match(header.decode(errors="ignore")):
+            header = b""
+        f.seek(max(offset, len(header)))
+        data = f.read()
+    # leave a partly written last line for the next call
+    data = data[:data.rfind(b"\n") + 1]
+    day = split["day"] if offset else None
+    lines = dict()
+    for line in data.splitlines(True):
+        match = DAY_PATTERN.match(line.decode(errors="ignore"))
+        if match:
+            day = match.group(0)
+        if day is not None:
+            lines.setdefault(day, []).append(line)
+    written = []
+    for segment_day, segment_lines in sorted(lines.items()):
+        path = os.path.join(segment_dir, "{0}_{1}{2}".format(stem, segment_day, ext))
+        new = offset == 0 or not os.path.exists(path)
+        with open(path, "wb" if new else "ab") as f:
+            f.write((header if new else b"") + b"".join(segment_lines))
+        written.append(path)
+    state.state["segments"][os.path.abspath(source)] = {"offset": max(offset, len(header)) + len(data), "day": day}
+    state.save()
+    return written
+
+
+def sync(source, folder, credential, state, chunk_size=5 * 1024 * 1024):
+    """
+    Uploads a file, or every file in a directory, skipping those unchanged since the last upload.
+    :return: number of files uploaded
+    """
+    if os.path.isdir(source):
+        files = sorted(os.path.join(source, i) for i in os.listdir(source)
+                       if not i.startswith(".") and os.path.isfile(os.path.join(source, i)))
+    else:
+        files = [source]
+    return sum(upload_file(i, folder, credential, state, chunk_size) for i in files)
 
 
 def main():
@@ -65,14 +239,31 @@ def main():
     parser.add_argument("-c", "--credential", help="path to Google API credential JSON file",
                         default="client_secret.json")
     parser.add_argument("-f", "--folder", help="name of google drive folder")
-    parser.add_argument("-s", "--source", help="path to file for upload")
+    parser.add_argument("-s", "--source", help="path to file or directory of files for upload")
+    parser.add_argument("--state", help="path to the upload state file, defaults to .sync_state.json "
+                                        "next to the source", default=None)
+    parser.add_argument("--chunk-size", help="MB per resumable upload request", type=float, default=5)
+    parser.add_argument("-d", "--daily", help="split the source log into daily segments and upload "
+                                              "only the segments that changed", action="store_true")
+    parser.add_argument("--segment-dir", help="directory of the daily segments, defaults to <source>_segments",
+                        default=None)
     args = parser.parse_args()
     credential = args.credential
     folder = args.folder
     source = args.source
+    state_path = args.state
+    if state_path is None:
+        state_path = os.path.join(os.path.dirname(os.path.abspath(source.rstrip(os.sep))), ".sync_state.json")
+    state = SyncState(state_path)
+    chunk_size = int(args.chunk_size * 1024 * 1024)
+    if args.daily:
+        segment_dir = args.segment_dir or os.path.splitext(source)[0] + "_segments"
+        print("{0}: Splitting {1} into daily segments in {2}".format(datetime.now(), source, segment_dir))
+        split_daily(source, segment_dir, state)
+        source = segment_dir
     print("{0}: Uploading {1} to Google Drive folder: {2}".format(datetime.now(), source, folder))
-    upload_file(source, folder, credential)
-
+    uploaded = sync(source, folder, credential, state, chunk_size)
+    print("{0}: {1} file(s) uploaded".format(datetime.now(), uploaded))
 
 
 if __name__ == "__main__":
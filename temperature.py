@@ -0,0 +1,145 @@
+import fcntl
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import hardware
+from metrics import metrics
+
+# File layout: header of (next slot, number of readings) then size slots of (unix time, temperature)
+HEADER = struct.Struct("<QQ")
+RECORD = struct.Struct("<dd")
+
+
+class TemperatureLog:
+    """
+    The last size temperature readings in a fixed size file used as a ring buffer, so the latest
+    temperature is available to every process on the Pi without downloading the temperature sheet.
+    Each access locks the file, so Qwiic_scales.py and irrigation.py can share it.
+    """
+
+    def __init__(self, path, size=1440):
+        """
+        :param path: ring buffer file, created if missing
+        :param size: number of readings kept, a day at one reading a minute by default
+        """
+        self.path = path
+        self.size = size
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(HEADER.pack(0, 0) + b"\0" * RECORD.size * size)
+        else:
+            # an existing file keeps its own size
+            self.size = (os.path.getsize(path) - HEADER.size) // RECORD.size
+
+    def append(self, temperature, timestamp=None):
+        """
+        :param temperature: temperature in C
+        :param timestamp: unix time of the reading, now if None
+        :return: None
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with open(self.path, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            next_slot, count = HEADER.unpack(f.read(HEADER.size))
+            f.seek(HEADER.size + next_slot * RECORD.size)
+            f.write(RECORD.pack(timestamp, temperature))
+            f.seek(0)
+            f.write(HEADER.pack((next_slot + 1) % self.size, min(count + 1, self.size)))
+
+    def get_records(self):
+        """
+        :return: list of (unix time, temperature) from oldest to newest
+        """
+        with open(self.path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            data = f.read()
+        next_slot, count = HEADER.unpack_from(data)
+        first = (next_slot - count) % self.size
+        return [RECORD.unpack_from(data, HEADER.size + ((first + i) % self.size) * RECORD.size) for i in range(count)]
+
+    def get_latest(self, max_age=None):
+        """
+        :param max_age: seconds after which a reading is too old to use, None to accept any age
+        :return: tuple of (unix time, temperature) or None if there is no recent enough reading
+        """
+        with open(self.path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            next_slot, count = HEADER.unpack(f.read(HEADER.size))
+            if count == 0:
+                return None
+            f.seek(HEADER.size + ((next_slot - 1) % self.size) * RECORD.size)
+            latest = RECORD.unpack(f.read(RECORD.size))
+        if max_age is not None and time.time() - latest[0] > max_age:
+            return None
+        return latest
+
+
+class TemperatureMonitor:
+    """
+    Reads the DS18B20 off the calling thread, either once with read_async() so the ~750 ms
+    conversion overlaps other work, or every interval seconds from a background thread with
+    start(). Every reading is added to the TemperatureLog.
+    """
+
+    def __init__(self, log, sensor=None, interval=60):
+        """
+        :param log: TemperatureLog
+        :param sensor: object with get_temperature(), the backend's DS18B20 if None
+        :param interval: seconds between readings of the background thread
+        """
+        self.log = log
+        self.sensor = sensor
+        self.interval = interval
+        self.executor = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def get_sensor(self):
+        if self.sensor is None:
+            self.sensor = hardware.get_backend().make_thermometer()
+        return self.sensor
+
+    def read(self):
+        """
+        Reads the sensor and logs the reading.
+        :return: temperature in C
+        """
+        with metrics.timer("stage_seconds", stage="temperature"):
+            temperature = self.get_sensor().get_temperature()
+        self.log.append(temperature)
+        return temperature
+
+    def read_async(self):
+        """
+        :return: Future of read()
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        return self.executor.submit(self.read)
+
+    def get_latest(self, max_age=None):
+        return self.log.get_latest(max_age)
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.read()
+            except Exception as e:
+                print("Temperature read failed: {0}".format(e))
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Qwiic_scales import CalibrationStore  # noqa: E402
+
+
+def write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def test_recalibration_replaces_calibration_without_temperature(tmp_path):
+    path = str(tmp_path / "cal.json")
+    write_json(path, {"0x70": {"0": [100.0, 2000.0]}})
+    store = CalibrationStore(path)
+    store.add("0x70", 0, 150.0, 2100.0, 21.0)
+    store.save()
+
+    store = CalibrationStore(path)
+    assert not store.needs_temperature()
+    assert store.lookup("0x70", "0", None) == (150.0, 2100.0)
+    with open(path) as f:
+        assert "default" not in json.load(f)["0x70"]["0"]
+
+
+def test_calibration_at_temperature_wins_over_default_in_file(tmp_path):
+    path = str(tmp_path / "cal.json")
+    write_json(path, {"0x70": {"0": {"default": [100.0, 2000.0], "21.0": [150.0, 2100.0]}}})
+    store = CalibrationStore(path)
+    assert store.lookup("0x70", "0", None) == (150.0, 2100.0)
+    assert store.lookup("0x70", "0", 30.0) == (150.0, 2100.0)
+
+
+def test_legacy_files_only_loaded_when_imported(tmp_path):
+    path = str(tmp_path / "cal.json")
+    write_json(path, {"0x70": {"0": [100.0, 2000.0]}})
+    write_json(str(tmp_path / "10_cal.json"), {"0x70": {"0": [10.0, 1000.0]}})
+    write_json(str(tmp_path / "30_cal.json"), {"0x70": {"0": [30.0, 3000.0]}})
+
+    store = CalibrationStore(path)
+    assert not store.needs_temperature()
+    assert store.lookup("0x70", "0", 20.0) == (100.0, 2000.0)
+
+    store = CalibrationStore(path, import_legacy=True)
+    assert store.needs_temperature()
+    assert store.lookup("0x70", "0", 20.0) == (20.0, 2000.0)
+
+
+def test_reset_forgets_earlier_calibrations(tmp_path):
+    path = str(tmp_path / "cal.json")
+    store = CalibrationStore(path)
+    store.add("0x70", 0, 10.0, 1000.0, 10.0)
+    store.add("0x70", 0, 30.0, 3000.0, 30.0)
+    store.reset("0x70", 0)
+    store.add("0x70", 0, 50.0, 5000.0, 21.0)
+    assert not store.needs_temperature()
+    assert store.lookup("0x70", "0", 10.0) == (50.0, 5000.0)
@@ -0,0 +1,178 @@
+import os
+import struct
+from datetime import datetime, timedelta
+
+# One reading: timestamp (int64 ns since 1970-01-01 in the Pi's local time, as logged), multiplexer
+# (valve) and port as small ints, one pad byte, then weight (kg) and raw reading as float32
+RECORD = struct.Struct("<qHBxff")
+DTYPE = [("timestamp", "<i8"), ("mux", "<u2"), ("port", "u1"), ("pad", "u1"), ("weight", "<f4"), ("raw", "<f4")]
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_ns(timestamp):
+    """
+    :param timestamp: datetime or ISO format string as written by datetime.isoformat()
+    :return: int64 nanoseconds since 1970-01-01
+    """
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return (timestamp - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def from_ns(ns):
+    return EPOCH + timedelta(microseconds=int(ns) // 1000)
+
+
+class TimeSeriesStore:
+    """
+    Append-only binary weight log, one file of fixed width records per day (YYYY-MM-DD.bin), about
+    20 bytes a reading against 60-70 for a CSV row. Records are appended in time order, so a time
+    range is found by binary search on the memory-mapped timestamps and only the pages holding it
+    are read. A day that received an out of order timestamp (eg. after the clock was stepped) is
+    marked with a .unsorted file and scanned instead.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.last_timestamps = dict()
+
+    def get_path(self, day):
+        return os.path.join(self.directory, "{0}.bin".format(day))
+
+    def get_unsorted_path(self, day):
+        return os.path.join(self.directory, "{0}.unsorted".format(day))
+
+    def get_days(self):
+        """
+        :return: sorted list of the days with data as YYYY-MM-DD strings
+        """
+        return sorted(i[:-4] for i in os.listdir(self.directory) if i.endswith(".bin"))
+
+    def get_last_timestamp(self, day):
+        """
+        :return: last timestamp written to the day's file, reading it from disk the first time
+        """
+        if day not in self.last_timestamps:
+            self.last_timestamps[day] = None
+            path = self.get_path(day)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            whole = size - size % RECORD.size
+            if whole != size:
+                # drop a record cut short by a power cut so the file stays aligned
+                with open(path, "r+b") as f:
+                    f.truncate(whole)
+            if whole:
+                with open(path, "rb") as f:
+                    f.seek(whole - RECORD.size)
+                    self.last_timestamps[day] = RECORD.unpack(f.read(RECORD.size))[0]
+        return self.last_timestamps[day]
+
+    def append(self, rows):
+        """
+        :param rows: list of [timestamp, multiplexer, scale, weight, raw] rows as written to the weight sheet,
+            the multiplexer (valve) and scale must be numbers
+        :return: None
+        """
+        days = dict()
+        # a cycle's rows share one timestamp, so each is only parsed once
+        parsed = dict()
+        for timestamp, mux, port, weight, raw in rows:
+            if timestamp not in parsed:
+                value = datetime.fromisoformat(timestamp) if isinstance(timestamp, str) else timestamp
+                parsed[timestamp] = (value.date().isoformat(), to_ns(value))
+            day, ns = parsed[timestamp]
+            days.setdefault(day, []).append((ns, int(mux), int(port), float(weight), float(raw)))
+        for day, records in days.items():
+            self.write_day(day, b"".join(RECORD.pack(*record) for record in records), [record[0] for record in records])
+
+    def append_records(self, records):
+        """
+        Same as append() for readings already packed as DTYPE records, eg. by readings.ReadingBuffer.
+        :param records: numpy structured array of DTYPE records
+        :return: None
+        """
+        import numpy as np
+
+        if len(records) == 0:
+            return
+        # a cycle's records share one timestamp, so only the distinct timestamps are converted to days
+        stamps, inverse = np.unique(records["timestamp"], return_inverse=True)
+        days = np.array([from_ns(i).date().isoformat() for i in stamps])[inverse]
+        for day in sorted(set(days.tolist())):
+            selected = records[days == day]
+            self.write_day(day, selected.tobytes(), selected["timestamp"].tolist())
+
+    def write_day(self, day, data, times):
+        """
+        Appends packed records to a day's file, marking the day unsorted if they go back in time.
+        :param day: YYYY-MM-DD
+        :param data: bytes of RECORD packed records
+        :param times: timestamps of the records in the order written
+        :return: None
+        """
+        last = self.get_last_timestamp(day)
+        if (last is not None and times[0] < last) or any(b < a for a, b in zip(times, times[1:])):
+            open(self.get_unsorted_path(day), "a").close()
+        with open(self.get_path(day), "ab") as f:
+            f.write(data)
+        self.last_timestamps[day] = max(times) if last is None else max(last, max(times))
+
+    def query(self, start=None, end=None, scales=None):
+        """
+        Reads the readings in [start, end) without loading the rest of the history.
+        :param start: datetime or ISO string, None for the first reading
+        :param end: datetime or ISO string, None for the last reading
+        :param scales: list of (multiplexer, port) to return, None for all
+        :return: numpy structured array of DTYPE records in time order
+        """
+        import numpy as np
+
+        start_ns = to_ns(start) if start is not None else None
+        end_ns = to_ns(end) if end is not None else None
+        first_day = from_ns(start_ns).date().isoformat() if start_ns is not None else None
+        last_day = from_ns(end_ns).date().isoformat() if end_ns is not None else None
+        parts = []
+        for day in self.get_days():
+            if (first_day is not None and day < first_day) or (last_day is not None and day > last_day):
+                continue
+            self.get_last_timestamp(day)
+            path = self.get_path(day)
+            count = os.path.getsize(path) // RECORD.size
+            if count == 0:
+                continue
+            records = np.memmap(path, dtype=DTYPE, mode="r", shape=(count,))
+            if os.path.exists(self.get_unsorted_path(day)):
+                keep = np.ones(count, dtype=bool)
+                if start_ns is not None:
+                    keep &= records["timestamp"] >= start_ns
+                if end_ns is not None:
+                    keep &= records["timestamp"] < end_ns
+                records = records[keep]
+            else:
+                low = np.searchsorted(records["timestamp"], start_ns, "left") if start_ns is not None else 0
+                high = np.searchsorted(records["timestamp"], end_ns, "left") if end_ns is not None else count
+                records = records[low:high]
+            if scales is not None:
+                wanted = np.zeros(len(records), dtype=bool)
+                for mux, port in scales:
+                    wanted |= (records["mux"] == int(mux)) & (records["port"] == int(port))
+                records = records[wanted]
+            parts.append(np.array(records))
+        if not parts:
+            return np.zeros(0, dtype=DTYPE)
+        return np.concatenate(parts)
+
+    def to_dataframe(self, start=None, end=None, scales=None):
+        """
+        Same as query() as a DataFrame with the weight sheet's column names.
+        :return: DataFrame with Timestamp, Multiplexer, Scale, Weight and Raw columns
+        """
+        import pandas as pd
+
+        records = self.query(start, end, scales)
+        return pd.DataFrame({"Timestamp": pd.to_datetime(records["timestamp"], unit="ns"),
+                             "Multiplexer": records["mux"].astype(int),
+                             "Scale": records["port"].astype(int),
+                             "Weight": records["weight"].astype(float),
+                             "Raw": records["raw"].astype(float)})
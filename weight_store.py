@@ -0,0 +1,215 @@
+import csv
+import sqlite3
+import threading
+from datetime import datetime
+from metrics import metrics
+
+# Column names of a stored reading, matching the weight worksheet header
+COLUMNS = ["Timestamp", "Multiplexer", "Scale", "Weight", "Raw"]
+
+
+class WeightStore:
+    """
+    Append-only SQLite store of weight readings. Readings are written here first and copied to
+    upload sinks later, the store remembers the last row each sink has acknowledged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS readings ("
+                              "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                              "timestamp TEXT NOT NULL, "
+                              "multiplexer TEXT NOT NULL, "
+                              "scale TEXT NOT NULL, "
+                              "weight REAL, "
+                              "raw REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS readings_timestamp ON readings (timestamp)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS uploads ("
+                              "sink TEXT PRIMARY KEY, "
+                              "last_id INTEGER NOT NULL)")
+
+    def append(self, rows):
+        """
+        Appends readings to the store.
+        :param rows: list of [timestamp, multiplexer, scale, weight, raw] rows
+        :return: None
+        """
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT INTO readings (timestamp, multiplexer, scale, weight, raw) "
+                                  "VALUES (?, ?, ?, ?, ?)",
+                                  [(str(r[0]), str(r[1]), str(r[2]), r[3], r[4]) for r in rows])
+
+    def get_acknowledged(self, sink):
+        """
+        :param sink: name of the upload sink
+        :return: id of the last row acknowledged by the sink, 0 if none
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT last_id FROM uploads WHERE sink = ?", (sink,)).fetchone()
+        return row[0] if row else 0
+
+    def acknowledge(self, sink, last_id):
+        """
+        Records that the sink has stored every row up to and including last_id.
+        :param sink: name of the upload sink
+        :param last_id: id of the last uploaded row
+        :return: None
+        """
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO uploads (sink, last_id) VALUES (?, ?)", (sink, last_id))
+
+    def pending(self, sink, limit=500):
+        """
+        :param sink: name of the upload sink
+        :param limit: maximum number of rows to return
+        :return: list of (id, timestamp, multiplexer, scale, weight, raw) rows not yet acknowledged by the sink
+        """
+        last_id = self.get_acknowledged(sink)
+        with self.lock:
+            return self.conn.execute("SELECT id, timestamp, multiplexer, scale, weight, raw FROM readings "
+                                     "WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit)).fetchall()
+
+    def since(self, timestamp=None):
+        """
+        :param timestamp: ISO format timestamp, None for every reading
+        :return: list of (timestamp, multiplexer, scale, weight, raw) rows taken after timestamp, in insertion order
+        """
+        with self.lock:
+            if timestamp is None:
+                return self.conn.execute("SELECT timestamp, multiplexer, scale, weight, raw FROM readings "
+                                         "ORDER BY id").fetchall()
+            return self.conn.execute("SELECT timestamp, multiplexer, scale, weight, raw FROM readings "
+                                     "WHERE timestamp > ? ORDER BY id", (timestamp,)).fetchall()
+
+    def count_pending(self, sink):
+        last_id = self.get_acknowledged(sink)
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM readings WHERE id > ?", (last_id,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SheetsSink:
+    """
+    Upload sink appending rows to a Google worksheet.
+    """
+
+    def __init__(self, open_spreadsheet, spreadsheet, sheet_name):
+        """
+        :param open_spreadsheet: function returning the gspread Spreadsheet for a name
+        :param spreadsheet: name of Google spreadsheet
+        :param sheet_name: name of worksheet to append to
+        """
+        self.open_spreadsheet = open_spreadsheet
+        self.spreadsheet = spreadsheet
+        self.sheet_name = sheet_name
+        self.name = "sheets:{0}/{1}".format(spreadsheet, sheet_name)
+
+    def append(self, values):
+        sheet = self.open_spreadsheet(self.spreadsheet)
+        metrics.count("api_calls_total", call="values_append")
+        sheet.values_append(self.sheet_name,
+                            {'valueInputOption': "USER_ENTERED"},
+                            {'values': values})
+
+
+class CsvSink:
+    """
+    Local stand-in for the Sheets API, appends rows to a CSV file so the pipeline can run offline.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = "csv:{0}".format(path)
+
+    def append(self, values):
+        with open(self.path, "a", newline="") as f:
+            csv.writer(f).writerows(values)
+
+
+class Uploader:
+    """
+    Copies readings from a WeightStore to a sink in batches. Rows are only acknowledged once the
+    sink accepts them, so readings taken during an outage are back-filled on the next flush.
+    """
+
+    def __init__(self, store, sink, batch_size=500, retry_delay=5, max_retry_delay=300):
+        self.store = store
+        self.sink = sink
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def flush(self):
+        """
+        Uploads every pending row, one values_append per batch.
+        :return: number of rows uploaded
+        """
+        uploaded = 0
+        while True:
+            rows = self.store.pending(self.sink.name, self.batch_size)
+            if not rows:
+                return uploaded
+            with metrics.timer("stage_seconds", stage="upload"):
+                self.sink.append([list(row[1:]) for row in rows])
+            metrics.count("rows_uploaded_total", len(rows), sink=self.sink.name)
+            self.store.acknowledge(self.sink.name, rows[-1][0])
+            uploaded += len(rows)
+
+    def try_flush(self):
+        """
+        Flushes, logging rather than raising upload errors.
+        :return: True if every pending row was uploaded
+        """
+        try:
+            uploaded = self.flush()
+        except Exception as e:
+            print("{0}: upload to {1} failed, {2} rows pending: {3}".format(
+                datetime.now(), self.sink.name, self.store.count_pending(self.sink.name), e))
+            return False
+        if uploaded:
+            print("{0}: uploaded {1} rows to {2}".format(datetime.now(), uploaded, self.sink.name))
+        return True
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=60):
+        """
+        Flushes every interval seconds in a background thread, backing off exponentially after failures.
+        :param interval: seconds between flushes
+        :return: None
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(interval,), daemon=True)
+        self.thread.start()
+
+    def run(self, interval):
+        delay = interval
+        failures = 0
+        while not self.stop_event.wait(delay):
+            if self.try_flush():
+                failures = 0
+                delay = interval
+            else:
+                failures += 1
+                delay = min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+
+    def stop(self):
+        """
+        Stops the background thread and makes a final flush attempt.
+        :return: None
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.try_flush()